@@ -3,7 +3,7 @@ import random
 import pygame
 
 from scrolled_text_panel import ScrolledTextPanel
-from shared.card import CARD_BLACK, CARD_WHITE
+from shared.card import CARD_BLACK, CARD_WHITE, FilledCard
 
 BORDER = 5
 COLOR_WHITE = (255, 255, 255)
@@ -87,7 +87,7 @@ class CardSurface(pygame.Surface):
   def setCard(self, card):
     
     self.clearText()
-    if self.card is not None and self.card is not card:
+    if isinstance(self.card, FilledCard) and self.card is not card:
       self.card.unlinkAll()
     self.card = card
     if self.card is not None:
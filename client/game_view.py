@@ -1,4 +1,4 @@
-from shared.card import CARD_BLACK, CARD_WHITE
+from shared.card import CARD_BLACK, CARD_WHITE, FilledCard
 from shared.exceptions import CardLinkError
 from .constants import *
 from .view import View
@@ -7,7 +7,6 @@ from .scrolled_text_panel import ScrolledTextPanel
 from .card_surface import CardSurface
 from .player_indicators import PlayerIndicators
 
-import copy
 import pygame
 import pygame.locals as pl
 
@@ -103,8 +102,7 @@ class GameView(View):
       self.clearCard(i)
 
     for i in range(len(choices)):
-      card = copy.deepcopy(self.black_card.getCard())
-      card.unlinkAll()
+      card = FilledCard(self.black_card.getCard().card)
       for j in range(len(choices[i])):
         card.link(choices[i][j])
       self.cards[i]['card'].setEnable(self.mode == GAME_MODE_CZAR_DECIDING)
@@ -1,12 +1,54 @@
 from . import version
 from .constants import *
+from shared.card import FilledCard
+from shared.card_database_manager import COMPRESSION_METHODS, MAX_CARDS_PER_QUERY
+from shared.codec import getCodecNames
 from shared.messages import *
 from shared.protocol import JSONReceiver
 
-from collections import Counter
+from collections import Counter, deque
+import itertools
 import random
 
+from twisted.internet import reactor
+from twisted.internet.defer import Deferred
+from twisted.internet.protocol import Protocol
+from twisted.web.client import Agent, ResponseDone
+from twisted.web.http_headers import Headers
+
+# messages needed to sync the card database
+SYNC_MESSAGES = (MSG_DATABASE_QUERY, MSG_DATABASE_PUSH, MSG_DATABASE_DELTA, MSG_SYNC_FINISHED, MSG_CARDS, )
+
+# returns the ids of all cards referenced by the given message
+def getMessageCards(code, data):
+  if code == MSG_DRAW_CARDS:
+    return data.get('cards', [])
+  elif code == MSG_CZAR_CHANGE:
+    return [data['card']] if 'card' in data else []
+  elif code == MSG_CHOICES:
+    return list(itertools.chain(*data.get('choices', [])))
+  return []
+
+# writes the body of a http response into a card database download
+class DownloadReceiver(Protocol):
+  def __init__(self, download, finished):
+    self.download = download
+    self.finished = finished
+
+  def dataReceived(self, data):
+    self.download.write(data)
+
+  def connectionLost(self, reason):
+    if reason.check(ResponseDone):
+      self.finished.callback(None)
+    else:
+      self.finished.errback(reason)
+
 class ClientProtocol(JSONReceiver):
+  # chunk lists, deltas and answers to card queries
+  # might not fit into a single message
+  split_codes = (MSG_DATABASE_PUSH, MSG_DATABASE_DELTA, MSG_CARDS, )
+
   def __init__(self, factory):
     JSONReceiver.__init__(self, factory)
     self.addCallback(MODE_CLIENT_AUTHENTIFICATION, MSG_CLIENT_ACCEPTED, self.clientAccepted)
@@ -18,7 +60,14 @@ class ClientProtocol(JSONReceiver):
     self.addCallback(MODE_INITIAL_SYNC, MSG_CURRENT_USERS, self.currentUsers)
     self.addCallback(MODE_INITIAL_SYNC, MSG_DATABASE_QUERY, self.databaseQuery)
     self.addCallback(MODE_INITIAL_SYNC, MSG_DATABASE_PUSH, self.databasePush)
+    self.addCallback(MODE_INITIAL_SYNC, MSG_DATABASE_DELTA, self.databaseDelta)
     self.addCallback(MODE_INITIAL_SYNC, MSG_SYNC_FINISHED, self.syncFinished)
+    # the server offers its card database again after reloading it
+    for mode in (MODE_FREE_TO_JOIN, MODE_IN_GAME, ):
+      self.addCallback(mode, MSG_DATABASE_QUERY, self.databaseQuery)
+      self.addCallback(mode, MSG_DATABASE_PUSH, self.databasePush)
+      self.addCallback(mode, MSG_DATABASE_DELTA, self.databaseDelta)
+      self.addCallback(mode, MSG_SYNC_FINISHED, self.syncFinished)
     self.addCallback(MODE_FREE_TO_JOIN, MSG_CREATE_GAME, self.createGame)
     self.addCallback(MODE_FREE_TO_JOIN, MSG_JOIN_GAME, self.joinGame)
     self.addCallback(MODE_FREE_TO_JOIN, MSG_LOGGED_IN, self.loggedIn)
@@ -40,17 +89,89 @@ class ClientProtocol(JSONReceiver):
     self.addCallback(MODE_IN_GAME, MSG_CHOOSE_CARDS, self.chooseCards)
     self.addCallback(MODE_IN_GAME, MSG_CHOICES, self.choices)
     self.addCallback(MODE_IN_GAME, MSG_CZAR_DECISION, self.czarDecision)
+    self.addCallback(MODE_FREE_TO_JOIN, MSG_CARDS, self.cards)
+    self.addCallback(MODE_IN_GAME, MSG_CARDS, self.cards)
     self.setMode(MODE_CLIENT_AUTHENTIFICATION)
+    # ids of the cards requested by each query still unanswered
+    self.card_queries = deque()
     self.database_hash = None
+    # messages waiting for cards to be fetched
+    self.deferred_messages = deque()
+    # messages waiting for the card database to be synced
+    self.sync_messages = deque()
+    self.syncing = False
+    self.download = None
     self.identification = 'server'
+    self.known_hashes = []
     self.server_version = {'MAJOR': 0, 'MINOR': 0, 'REVISION': 0}
     self.factory.client = self
     self.user_id = 0
     self.game_id = 0
     self.manual_close = False
 
+  # messages referencing cards which weren't fetched yet
+  # (mostly when using a lazy card database, but also when the server
+  # uses cards of another card database than the synced one) will be
+  # deferred until the server sent those cards
+  # all following messages will be deferred as well, to keep their order
+  # while syncing another card database after the initial sync,
+  # all messages will be deferred until the sync finished,
+  # since they already refer to that card database
+  def messageReceived(self, code, data):
+    if code in SYNC_MESSAGES:
+      return JSONReceiver.messageReceived(self, code, data)
+
+    if self.syncing:
+      self.sync_messages.append((code, data, ))
+      return
+
+    ids = getMessageCards(code, data)
+    if len(ids):
+      self.queryCards(ids)
+
+    if not len(self.card_queries) and not len(self.deferred_messages):
+      return JSONReceiver.messageReceived(self, code, data)
+
+    self.deferred_messages.append((code, data, ids, ))
+    self.processDeferredMessages()
+
+  def processDeferredMessages(self):
+    pending = set(itertools.chain(*self.card_queries))
+    while len(self.deferred_messages):
+      code, data, ids = self.deferred_messages[0]
+      if not pending.isdisjoint(ids):
+        return
+      self.deferred_messages.popleft()
+      JSONReceiver.messageReceived(self, code, data)
+
+  # processes all messages deferred while syncing the card database,
+  # cards of the synced card database will be fetched again if needed
+  def processSyncMessages(self):
+    while len(self.sync_messages):
+      self.messageReceived(*self.sync_messages.popleft())
+
+  # requests all cards not cached and not requested yet
+  def queryCards(self, ids):
+    pending = set(itertools.chain(*self.card_queries))
+    missing = [id for id in self.factory.card_database.getMissingCards(ids) if id not in pending]
+    for i in range(0, len(missing), MAX_CARDS_PER_QUERY):
+      query = missing[i:i + MAX_CARDS_PER_QUERY]
+      self.card_queries.append(query)
+      self.sendMessage(MSG_CARDS_QUERY, ids = query)
+
+  # the answer to the oldest card query
+  # cards unknown to the server won't be contained, but will still
+  # be considered answered
+  # cards received while syncing might belong to either card database,
+  # they will be fetched again if needed
+  def cards(self, cards):
+    self.card_queries.popleft()
+    if not self.syncing:
+      self.factory.card_database.addCards(cards)
+    self.processDeferredMessages()
+
   def connectionMade(self):
-    self.sendMessage(MSG_CLIENT_AUTHENTIFICATION, major=version.MAJOR, minor=version.MINOR, revision=version.REVISION)
+    self.sendMessage(MSG_CLIENT_AUTHENTIFICATION, major=version.MAJOR, minor=version.MINOR, revision=version.REVISION, codecs=getCodecNames())
 
   def serverAuthentification(self, major, minor, revision):
     self.server_version = {'MAJOR': major, 'MINOR': minor, 'REVISION': revision}
@@ -58,7 +179,8 @@ class ClientProtocol(JSONReceiver):
   def clientRefused(self, reason):
     self.factory.display.view.clientRefusedMessage(reason)
 
-  def clientAccepted(self):
+  def clientAccepted(self, codec = 'json'):
+    self.setCodec(codec)
     username, password = self.factory.display.getLoginCredentials()
     self.sendMessage(MSG_USER_AUTHENTIFICATION, username=username, password=password)
     self.setMode(MODE_USER_AUTHENTIFICATION)
@@ -69,7 +191,7 @@ class ClientProtocol(JSONReceiver):
       self.user_id = user_id
       self.factory.display.view.syncMessage()
       self.setMode(MODE_INITIAL_SYNC)
-      self.sendMessage(MSG_DATABASE_QUERY)
+      self.sendMessage(MSG_DATABASE_QUERY, http=True)
     else:
       self.factory.display.view.errorMessage(message)
 
@@ -77,24 +199,114 @@ class ClientProtocol(JSONReceiver):
     if not success:
       self.factory.display.view.errorMessage(message)
 
-  def databaseQuery(self, hash):
+  # url is given if the server offers the database over http
+  def databaseQuery(self, hash, url = None):
+    # messages still waiting for cards of the previous card database
+    # will be processed with the new one
+    if self.getMode() != MODE_INITIAL_SYNC:
+      self.syncing = True
+      self.sync_messages.extendleft((code, data, ) for code, data, ids in reversed(self.deferred_messages))
+      self.deferred_messages.clear()
     self.factory.card_database.loadPath(self.factory.display.server_name, hash)
-    if not self.factory.card_database.loaded:
-      self.sendMessage(MSG_DATABASE_PULL)
+    if not self.factory.card_database.loaded and self.factory.display.config.get('lazy_card_database'):
+      # cards will be fetched whenever they are needed
+      self.factory.card_database.loadLazy(self.factory.display.server_name, hash)
+      self.factory.card_database.loadCards()
+      self.sendMessage(MSG_DATABASE_KNOWN)
+    elif not self.factory.card_database.loaded:
       self.database_hash = hash
+      # the server may be able to just send the changes to an older version
+      self.known_hashes = self.factory.card_database.getCachedHashes(self.factory.display.server_name)
+      if len(self.known_hashes):
+        self.sendDatabasePull(known=self.known_hashes)
+      elif url is not None:
+        self.downloadDatabase(url)
+      else:
+        self.sendDatabasePull()
     else:
       self.factory.card_database.loadCards()
       self.sendMessage(MSG_DATABASE_KNOWN)
 
-  def databasePush(self, size):
-    self.receiveRawData(size, self.databaseKnown)
+  # requests the card database, continuing a previously aborted download
+  def sendDatabasePull(self, **kwargs):
+    offset = self.factory.card_database.getPartialSize(self.factory.display.server_name, self.database_hash)
+    self.sendMessage(MSG_DATABASE_PULL, compression=COMPRESSION_METHODS, offset=offset, **kwargs)
+
+  # downloads the database over http instead of the game connection,
+  # continuing a previously aborted download by requesting the missing range
+  def downloadDatabase(self, url):
+    offset = self.factory.card_database.getPartialSize(self.factory.display.server_name, self.database_hash)
+    headers = Headers()
+    if offset > 0:
+      headers.addRawHeader('range', 'bytes=%d-'%(offset))
+    request = Agent(reactor).request('GET', url.encode('utf-8'), headers)
+    request.addCallback(self.databaseResponse, offset)
+    request.addCallbacks(self.databaseDownloaded, self.databaseDownloadFailed)
+
+  def databaseResponse(self, response, offset):
+    if response.code == 200:
+      # the server ignored the range
+      offset = 0
+    elif response.code != 206:
+      raise IOError('unexpected http status %d'%(response.code))
+    if not self.transport.connected:
+      return
+    # an interrupted download will be continued with a range request
+    self.download = self.factory.card_database.download(self.factory.display.server_name, self.database_hash, None, offset, resumable = True)
+    finished = Deferred()
+    response.deliverBody(DownloadReceiver(self.download, finished))
+    return finished
+
+  def databaseDownloaded(self, result):
+    download = self.download
+    if download is None:
+      # the connection got lost meanwhile
+      return
+    self.download = None
+    if not download.finish():
+      self.sendDatabasePull()
+      return
+    self.databaseLoaded()
+
+  # the database can still be pulled through the game connection
+  def databaseDownloadFailed(self, failure):
+    if self.download is not None:
+      self.download.abort()
+      self.download = None
+    if self.transport.connected:
+      self.sendDatabasePull()
+
+  def databasePush(self, size, compression = None, offset = 0, chunks = None):
+    self.download = self.factory.card_database.download(self.factory.display.server_name, self.database_hash, compression, offset, chunks)
+    self.receiveRawData(size, self.download, self.databaseKnown)
+
+  def databaseDelta(self, base, cards, removed, digest):
+    if not self.factory.card_database.applyDelta(self.factory.display.server_name, self.known_hashes[base], self.database_hash, {'cards': cards, 'removed': removed, 'digest': digest}):
+      # we'll need the whole database instead
+      self.sendDatabasePull()
+      return
+    self.databaseLoaded()
 
   def databaseKnown(self):
-    self.factory.card_database.loadData(self.raw_data, self.factory.display.server_name, self.database_hash)
+    download = self.download
+    self.download = None
+    if not download.finish():
+      self.factory.display.view.errorMessage(self.factory.display.translator.translate('The card database received from the server is corrupted.'))
+      self.loseConnection()
+      return
+    self.databaseLoaded()
+
+  def databaseLoaded(self):
+    self.factory.card_database.loadPath(self.factory.display.server_name, self.database_hash)
     self.factory.card_database.loadCards()
     self.sendMessage(MSG_DATABASE_KNOWN)
 
   def syncFinished(self):
+    # syncing a reloaded card database doesn't leave the current view
+    if self.getMode() != MODE_INITIAL_SYNC:
+      self.syncing = False
+      self.processSyncMessages()
+      return
     self.setMode(MODE_FREE_TO_JOIN)
     self.factory.display.setView('OverviewView')
     self.factory.display.login_sound.stop()
@@ -155,8 +367,9 @@ class ClientProtocol(JSONReceiver):
     self.factory.display.game_start_sound.stop()
     self.factory.display.game_start_sound.play()
 
+  # cards unknown even to the server will be left out
   def drawCards(self, cards):
-    cards = [self.factory.card_database.getCard(c) for c in cards]
+    cards = [c for c in self.factory.card_database.getCards(cards) if c is not None]
     self.factory.display.callFunction('self.view.setCards', *cards)
 
     self.factory.display.game_draw_sounds[random.randint(0, len(self.factory.display.game_draw_sounds)-1)].play()
@@ -169,7 +382,8 @@ class ClientProtocol(JSONReceiver):
       self.factory.display.callFunction('self.view.writeLog', self.factory.display.translator.translate("{player} was chosen the new czar and therefore flips a new black card open.").format(player = self.factory.findUsername(user_id)))
       self.factory.display.callFunction('self.view.setMode', GAME_MODE_PLAYER)
     card = self.factory.card_database.getCard(card)
-    self.factory.display.callFunction('self.view.setBlackCard', card)
+    if card is not None:
+      self.factory.display.callFunction('self.view.setBlackCard', FilledCard(card))
     self.factory.display.callFunction('self.view.player_indicators.setCzar', user_id)
     
   def currentUsers(self, users):
@@ -245,7 +459,7 @@ class ClientProtocol(JSONReceiver):
 
   def choices(self, choices):
 
-    choices = [[self.factory.card_database.getCard(c) for c in o] for o in choices]
+    choices = [[c for c in self.factory.card_database.getCards(o) if c is not None] for o in choices]
 
     if self.factory.display.view.mode == GAME_MODE_CZAR_WAITING:
       self.factory.display.callFunction('self.view.writeLog', self.factory.display.translator.translate('All players confirmed their choices. You now have to select the choice which you think is the best.'))
@@ -361,6 +575,11 @@ class ClientProtocol(JSONReceiver):
     self.sendMessage(MSG_DELETE_GAME, game_id = id)
 
   def connectionLost(self, reason):
+    JSONReceiver.connectionLost(self, reason)
+
+    if self.download is not None:
+      self.download.abort()
+      self.download = None
 
     if not self.manual_close and self.factory.display.running and self.getMode() not in [MODE_CLIENT_AUTHENTIFICATION, MODE_USER_AUTHENTIFICATION, MODE_INITIAL_SYNC]:
       self.factory.display.setView('LoginView')
@@ -368,4 +587,4 @@ class ClientProtocol(JSONReceiver):
 
   def loseConnection(self):
     self.manual_close = True
-    self.transport.loseConnection()
+    JSONReceiver.loseConnection(self)
@@ -1,5 +1,5 @@
 from const import *
-from shared.card import CARD_BLACK, CARD_WHITE, Card
+from shared.card import CARD_BLACK, CARD_WHITE, EditableCard
 
 
 
@@ -12,7 +12,7 @@ class CardPanel(wx.Panel):
                       name=("card %d" %card_id), style=wx.SIMPLE_BORDER)
     frame = self.GetTopLevelParent()
     self.SetName(frame.translator.translate("Card {number}").format(number = card_id))
-    self.card = Card(id=card_id, text=text, type=card_type)
+    self.card = EditableCard(id=card_id, text=text, type=card_type)
     
     # subpanel for more free space between panel-border and text
     self.subpanel = wx.Panel(self, name=self.GetName(), style=wx.NO_BORDER)
@@ -8,11 +8,19 @@ class ArgumentParser(object):
     self.parser.add_argument("-b", "--black-cards",help="the amount of black cards used per game", type=int, default=-1)
     self.parser.add_argument("-d", "--database", help="path to the database file", type=str, default="cards.db")
     self.parser.add_argument("-p","--port",help="port to start server on",type=int, default=11337)
+    self.parser.add_argument("--http-port", help="port to serve the card database over http on, disabled by default", type=int, default=None)
+    self.parser.add_argument("--http-url", help="url the card database will be advertised under instead, e.g. when hosted separately", type=str, default=None)
+    self.parser.add_argument("--admin", help="name of a user allowed to reload the card database, may be given multiple times", type=str, action="append", default=[])
+    self.parser.add_argument("--checkpoint-interval", help="interval in seconds in which changed games will be saved, 0 saves them on shutdown only", type=int, default=30)
 
   def execute(self):
     args=self.parser.parse_args()
 
     self.port = args.port
+    self.admins = args.admin
+    self.checkpoint_interval = max(args.checkpoint_interval, 0)
+    self.http_port = args.http_port
+    self.http_url = args.http_url
 
     if args.black_cards<=0:
       args.black_cards = -1
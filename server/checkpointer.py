@@ -0,0 +1,137 @@
+from collections import OrderedDict
+
+from twisted.internet import defer, task
+from twisted.logger import Logger
+from twisted.python.failure import Failure
+
+# saves all games which changed since the last checkpoint into the server
+# database in regular intervals, so a crashed server won't lose them
+# games are packed one at a time, spread across reactor iterations,
+# and written by the database pool in a single transaction
+# open and deleted games aren't saved, their rows will be deleted instead
+class Checkpointer(object):
+  log = Logger()
+
+  def __init__(self, factory, pool, interval):
+    # game -> None, in the order the games changed
+    self.dirty = OrderedDict()
+    self.factory = factory
+    # games collected by the checkpoint currently running
+    self.checkpoint_games = []
+    self.interval = interval
+    self.loop = None
+    self.pool = pool
+    # deferred of the checkpoint currently running, if any
+    self.running = None
+    # deferreds waiting for the next checkpoint to finish
+    self.waiting = []
+
+  def start(self):
+    if self.interval > 0:
+      self.loop = task.LoopingCall(self.checkpoint)
+      self.loop.start(self.interval, now = False)
+
+  def stop(self):
+    if self.loop is not None and self.loop.running:
+      self.loop.stop()
+    self.loop = None
+
+  # needs to be called whenever a game changed, got opened or deleted
+  def markDirty(self, game):
+    self.dirty[game] = None
+
+  # whether the latest changes of the game weren't saved yet
+  def isPending(self, game):
+    return game in self.dirty or game in self.checkpoint_games
+
+  # collects the changes of all dirty games,
+  # yielding after every game to let the reactor handle other work
+  def collect(self, games, rows, removed):
+    while len(self.dirty):
+      game, _ = self.dirty.popitem(last = False)
+      games.append(game)
+      if game.open or self.factory.findGame(game.id) is not game:
+        removed.append(game.uuid.hex)
+      else:
+        rows.append(game.pack())
+      yield
+
+  # returns a deferred firing once a checkpoint started after calling this
+  # finished, i.e. all games changed until now were saved
+  def requestCheckpoint(self):
+    d = defer.Deferred()
+    self.waiting.append(d)
+    self.checkpoint()
+    return d
+
+  def checkpoint(self):
+    # a checkpoint taking longer than the interval will just delay the next one
+    if self.running is not None:
+      return
+
+    waiting = self.waiting
+    self.waiting = []
+
+    if not len(self.dirty):
+      for d in waiting:
+        d.callback(None)
+      return
+
+    rows = []
+    removed = []
+    self.checkpoint_games = []
+
+    d = task.cooperate(self.collect(self.checkpoint_games, rows, removed)).whenDone()
+    d.addCallback(lambda _: self.pool.runInteraction(self.write, rows, removed))
+    d.addCallbacks(self.checkpointed, self.checkpointFailed, callbackArgs = (rows, removed, ))
+    d.addBoth(self.checkpointFinished, waiting)
+    self.running = d
+
+  def checkpointed(self, result, rows, removed):
+    self.checkpoint_games = []
+    self.log.debug('checkpoint saved {saved} and removed {removed} games', saved = len(rows), removed = len(removed))
+
+  # the changes will be retried with the next checkpoint
+  def checkpointFailed(self, failure):
+    self.log.failure('checkpoint failed', failure)
+    for game in self.checkpoint_games:
+      self.markDirty(game)
+    self.checkpoint_games = []
+    return failure
+
+  def checkpointFinished(self, result, waiting):
+    self.running = None
+    for d in waiting:
+      if isinstance(result, Failure):
+        d.errback(result)
+      else:
+        d.callback(None)
+    # checkpoints requested while this one was running
+    if len(self.waiting):
+      self.checkpoint()
+
+  # writes all remaining changes synchronously using the given connection,
+  # meant to be used when shutting down
+  # returns the amount of saved games
+  def flush(self, connection):
+    # the running checkpoint might not have been written yet
+    for game in self.checkpoint_games:
+      self.markDirty(game)
+
+    rows = []
+    removed = []
+    for _ in self.collect([], rows, removed):
+      pass
+
+    cursor = connection.cursor()
+    self.write(cursor, rows, removed)
+    connection.commit()
+    return len(rows)
+
+  @staticmethod
+  def write(cursor, rows, removed):
+    if len(removed):
+      cursor.executemany('DELETE FROM games WHERE id = ?', [(id, ) for id in removed])
+    if len(rows):
+      columns = rows[0].keys()
+      cursor.executemany('INSERT OR REPLACE INTO games ('+','.join(columns)+') VALUES ('+','.join('?' * len(columns))+')', [tuple(row[c] for c in columns) for row in rows])
@@ -0,0 +1,46 @@
+import os.path
+import re
+
+from twisted.web import http
+from twisted.web.resource import NoResource, Resource
+from twisted.web.static import File
+
+HASH_EXPRESSION = re.compile('^[0-9a-f]{128}$')
+
+# a card database served over http
+# databases are addressed by their hash, so their content never changes
+# and they can be cached forever
+# ranges and conditional requests are handled by File itself,
+# the hash additionally serves as etag
+class CardDatabaseFile(File):
+  isLeaf = True
+
+  def __init__(self, path, hash):
+    File.__init__(self, path, defaultType = 'application/octet-stream')
+    self.hash = hash
+
+  def render_GET(self, request):
+    request.setHeader('cache-control', 'public, max-age=31536000, immutable')
+    if request.setETag('"%s"'%(self.hash)) is http.CACHED:
+      return ''
+    return File.render_GET(self, request)
+
+  render_HEAD = render_GET
+
+# serves all archived card databases, including the current one, as /<hash>
+class CardDatabaseResource(Resource):
+
+  def __init__(self, factory):
+    Resource.__init__(self)
+    self.factory = factory
+
+  def getChild(self, name, request):
+    if not HASH_EXPRESSION.match(name):
+      return NoResource()
+
+    # the current card database is archived as well,
+    # in case its file gets replaced before reloading it
+    path = self.factory.card_database.makePath(self.factory.archive_name, name)
+    if not os.path.exists(path):
+      return NoResource()
+    return CardDatabaseFile(path, name)
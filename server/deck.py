@@ -0,0 +1,99 @@
+from array import array
+import hashlib
+import random
+
+# a pile of cards, stored as compact array of card ids
+# the order of the pile is derived from a seed, a salt (usually the card
+# database hash) and the amount of reshuffles (epoch) only, so saving a deck
+# just requires a few integers, plus the cards which were put back onto it
+# cards are drawn by moving the cursor forward, so drawing never needs to
+# move the remaining cards around
+class Deck(object):
+
+  # cards are the ids of all cards this deck consists of
+  # if limit is None, the deck will be reshuffled as soon as it runs empty,
+  # otherwise only the first limit cards of the shuffled deck can be drawn
+  def __init__(self, cards, seed, salt, limit = None):
+    self.cards = cards
+    self.cursor = 0
+    self.epoch = 0
+    self.limit = limit
+    self.order = None
+    self.returned = array('I')
+    self.salt = salt
+    self.seed = seed
+    self.shuffle()
+
+  @classmethod
+  def load(cls, cards, seed, salt, data, limit = None):
+    deck = cls(cards, seed, salt, limit)
+    deck.epoch = data['epoch']
+    deck.cursor = data['cursor']
+    deck.returned = array('I', data['returned'])
+    deck.shuffle()
+    return deck
+
+  # returns the amount of cards left in a packed deck consisting of
+  # size cards, without having to shuffle it
+  @staticmethod
+  def packedLength(data, size, limit = None):
+    end = size if limit is None else min(limit, size)
+    return len(data['returned']) + end - data['cursor']
+
+  def pack(self):
+    return {
+            'epoch': self.epoch,
+            'cursor': self.cursor,
+            'returned': self.returned.tolist()
+           }
+
+  def shuffle(self):
+    seed = hashlib.sha256('%d:%s:%d'%(self.seed, self.salt, self.epoch)).hexdigest()
+    self.order = array('I', self.cards)
+    random.Random(long(seed, 16)).shuffle(self.order)
+
+  @property
+  def end(self):
+    if self.limit is None:
+      return len(self.order)
+    return min(self.limit, len(self.order))
+
+  # returns the next card id and removes it from the pile
+  # card ids found in skip (e.g. cards currently held by any player)
+  # won't be drawn
+  def draw(self, skip = ()):
+    if len(self.returned):
+      return self.returned.pop()
+
+    reshuffled = False
+
+    while True:
+      if self.cursor >= self.end:
+        if self.limit is not None or reshuffled:
+          raise IndexError('deck is empty')
+        self.epoch += 1
+        self.cursor = 0
+        self.shuffle()
+        reshuffled = True
+
+      card = self.order[self.cursor]
+      self.cursor += 1
+
+      if card not in skip:
+        return card
+
+  # returns the next card id without removing it, or None if the deck is empty
+  # only meant for decks which don't need to skip any cards
+  def peek(self):
+    if len(self.returned):
+      return self.returned[-1]
+    if self.cursor >= self.end:
+      return None
+    return self.order[self.cursor]
+
+  # puts the given card ids back on top of the pile, keeping their order
+  def putBack(self, cards):
+    self.returned.extend(reversed(cards))
+
+  def __len__(self):
+    return len(self.returned) + self.end - self.cursor
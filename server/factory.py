@@ -1,40 +1,111 @@
+from collections import OrderedDict
 import os.path
+import time
+import weakref
+from twisted.internet import defer, task, threads
 from twisted.internet.protocol import Factory
 from twisted.logger import Logger
-import sqlite3
+from twisted.python.failure import Failure
 
-from .game import Game
+from .checkpointer import Checkpointer
+from .game import Game, GameStub
+from .journal import Journal, JOURNAL_COMPACT_SIZE
+from . import journal
 from .protocol import ServerProtocol
+from . import server_database
+from .user_repository import UserRepository
 from . import version
 from shared.card_database_manager import CardDatabaseManager
 from shared.path import getScriptDirectory
 
+# paused games nobody joined for this amount of seconds will be
+# spilled back into the server database, see spillGames()
+PAUSED_GAME_IDLE_TIME = 600
+
+# the maximum amount of loaded paused games nobody joined
+PAUSED_GAME_LIMIT = 100
+
+# paused games will be checked for spilling every this amount of seconds
+SPILL_INTERVAL = 60
+
+# the maximum amount of card database deltas kept in memory
+DELTA_CACHE_SIZE = 16
+
 class ServerFactory(Factory):
   black_cards = -1
   card_database = None
-  games = []
+  checkpointer = None
+  database_pool = None
+  journal = None
   log = Logger()
   serverDatabase = None
-  users=[]
+  user_repository = None
 
-  def __init__(self, black_cards, database_file):
+  def __init__(self, black_cards, database_file, http_port = None, http_url = None, checkpoint_interval = 0, admins = ()):
+    # names of the users allowed to reload the card database
+    self.admins = frozenset(admins)
     self.black_cards = black_cards
+    # the amount of black cards requested on the command line,
+    # black_cards is limited to what the current card database contains
+    self.requested_black_cards = black_cards
+    # card database hash -> catalog, every game keeps the catalog it is
+    # played with alive, see getCardDatabase()
+    self.card_databases = weakref.WeakValueDictionary()
+    # games will be saved every checkpoint_interval seconds, 0 disables that
+    self.checkpoint_interval = checkpoint_interval
+    # (card database hash, compression) -> deferreds waiting for the
+    # card database to be split into chunks
+    self.chunking_databases = {}
+    # (base hash, card database hash) -> delta between both versions,
+    # the least recently used ones will be dropped, see DELTA_CACHE_SIZE
+    self.database_deltas = OrderedDict()
+    # (base hash, card database hash) -> deferreds waiting for the delta
+    # between both versions to be computed
+    self.computing_deltas = {}
+    # (card database hash, compression) -> card database split into chunks
+    self.database_chunks = {}
+    self.compacting_journal = False
+    self.journal_replaying = False
     self.database_file = database_file
+    # deferreds waiting for the card database reload currently running
+    self.reloading = None
+    # game stub -> deferreds waiting for the whole game to be loaded
+    self.hydrating = {}
+    # the card database may be served over http as well, see database_resource
+    # http_url replaces the default url pointing to this server
+    self.http_port = http_port
+    self.http_url = http_url
+    # all registries are keyed so that lookups don't need to scan
+    # games: game id -> game, game_names: game name -> game
+    # users: all connected users (logged in or not), user_ids: user id -> user
+    # paused_games: user id -> set of paused games this user is a member of
+    # game_members: game -> user ids currently indexed in paused_games
+    self.games = OrderedDict()
+    self.game_names = {}
+    self.game_members = {}
+    self.paused_games = {}
+    self.user_ids = {}
+    self.spill_loop = None
+    self.users = OrderedDict()
 
   def buildProtocol(self, addr):
     return ServerProtocol(self)
 
   def openServerDatabase(self):
-    self.serverDatabase = sqlite3.connect(os.path.join(getScriptDirectory(), "server.db"))
-    cursor = self.serverDatabase.cursor()
-    cursor.execute("CREATE TABLE IF NOT EXISTS 'users' ('id' INTEGER PRIMARY KEY, 'name' VARCHAR(30), 'password' CHAR(128))")
-    cursor.execute("CREATE TABLE IF NOT EXISTS 'games' ('id' CHAR(32), 'name' VARCHAR(30), 'users' TEXT, 'cards' TEXT, 'password_hash' CHAR(128), 'database_hash' CHAR(128), 'server_version_major' TINYINT, 'server_version_minor' TINYINT, 'server_version_revision' TINYINT)")
-    self.serverDatabase.commit()
+    path = os.path.join(getScriptDirectory(), "server.db")
+    self.serverDatabase = server_database.openDatabase(path)
+    # users and checkpoints are accessed while the server is running,
+    # which mustn't block the reactor
+    self.database_pool = server_database.openPool(path)
+    self.user_repository = UserRepository(self.database_pool)
+    self.checkpointer = Checkpointer(self, self.database_pool, self.checkpoint_interval)
     self.log.info("Loaded server database")
 
+  # saved games are only loaded as stubs, the whole game will be loaded
+  # as soon as somebody joins it, see requestGame()
   def loadGames(self):
     cursor = self.serverDatabase.cursor()
-    cursor.execute('SELECT * FROM games where database_hash = ? and server_version_major = ? and server_version_minor = ?', (self.card_database.hash, version.MAJOR, version.MINOR, ))
+    cursor.execute('SELECT id, name, snapshot, password_hash, database_hash, journal_seq FROM games where database_hash = ? and server_version_major = ? and server_version_minor = ?', (self.card_database.hash, version.MAJOR, version.MINOR, ))
     
     game_rows = cursor.fetchall()
 
@@ -42,77 +113,446 @@ class ServerFactory(Factory):
       game = {}
       for colid in range(len(row)):
         game[cursor.description[colid][0]] = row[colid]
-      game = Game.load(self, **game)
-      self.games.append(game)
+      self.addGame(GameStub.load(self, **game))
 
-    cursor.execute('DELETE FROM games')
-    cursor.execute('VACUUM')
+    # games which can't be loaded anymore won't ever be
+    # the loaded ones will be kept up to date by the checkpointer instead
+    # sqlite reuses the freed pages, so there's no need to vacuum
+    cursor.execute('DELETE FROM games WHERE NOT (database_hash = ? and server_version_major = ? and server_version_minor = ?)', (self.card_database.hash, version.MAJOR, version.MINOR, ))
     self.serverDatabase.commit()
-    self.log.info('loaded {count} games from database', count = len(self.games))
+    self.log.info('found {count} games in database', count = len(self.games))
 
-  def startFactory(self):
-    self.card_database = CardDatabaseManager()
-    self.card_database.loadPath(self.database_file)
-    self.card_database.loadCards()
+  def loadGame(self, data):
+    game = Game.load(self, **data)
+    self.addGame(game)
+    return game
+
+  # returns the saved row of the game with the given id as dict,
+  # or None if there is no such game
+  @staticmethod
+  def readGame(cursor, id):
+    cursor.execute('SELECT * FROM games WHERE id = ?', (id, ))
+    row = cursor.fetchone()
+    if row is None:
+      return None
+    return dict((cursor.description[colid][0], row[colid], ) for colid in range(len(row)))
+
+  # loads the whole game a stub stands in for synchronously,
+  # only meant to be used while starting up
+  def hydrateGame(self, stub):
+    return self.replaceStub(stub, self.readGame(self.serverDatabase.cursor(), stub.uuid.hex))
+
+  # returns a deferred firing with the whole game the stub stands in for,
+  # or None if the game was deleted in the meantime
+  # the game will only be read once, no matter how many users request it
+  def requestGame(self, stub):
+    d = defer.Deferred()
+    if stub in self.hydrating:
+      self.hydrating[stub].append(d)
+    else:
+      self.hydrating[stub] = [d]
+      r = self.database_pool.runInteraction(self.readGame, stub.uuid.hex)
+      r.addCallback(lambda data: self.replaceStub(stub, data))
+      r.addBoth(self.gameRequested, stub)
+    return d
+
+  def gameRequested(self, result, stub):
+    if isinstance(result, Failure):
+      self.log.failure('unable to load game {game}', result, game = stub.id)
+    for d in self.hydrating.pop(stub):
+      if isinstance(result, Failure):
+        d.errback(result)
+      else:
+        d.callback(result)
+
+  def replaceStub(self, stub, data):
+    # the stub got deleted or replaced in the meantime
+    if self.findGame(stub.id) is not stub:
+      return self.findGame(stub.id)
+    if data is None:
+      self.log.warn('game {game} not found in database', game = stub.id)
+      self.unlinkGame(stub)
+      return None
+    game = Game.load(self, **data)
+    self.replaceGame(stub, game)
+    self.log.debug('loaded game {game}', game = game.id)
+    return game
+
+  # spills paused games nobody joined back into the server database,
+  # replacing them by stubs, as soon as they weren't used for a while
+  # or more of them than allowed are loaded, least recently used first
+  # games can only be spilled once all their changes were saved
+  def spillGames(self):
+    now = time.time()
+    games = sorted([g for g in self.getAllGames() if not g.stub and not g.open and not g.running and len(g.getAllUsers()) == 0], key = lambda g: g.last_activity)
+    excess = len(games) - PAUSED_GAME_LIMIT
+    pending = False
+    spilled = 0
+
+    for game in games:
+      if excess <= 0 and now - game.last_activity < PAUSED_GAME_IDLE_TIME:
+        break
+      if self.checkpointer.isPending(game):
+        pending = True
+        continue
+      self.replaceGame(game, GameStub.fromGame(game))
+      excess -= 1
+      spilled += 1
+
+    # these can be spilled next time
+    if pending:
+      self.checkpointer.checkpoint()
 
-    if len(self.card_database.getBlackCards())<self.black_cards:
-      self.black_cards = len(self.card_database.getBlackCards())
+    if spilled > 0:
+      self.log.debug('spilled {count} paused games', count = spilled)
+
+  # applies everything that happened to the games since they were saved
+  # the last time, which will only be the case after a crash
+  def replayJournal(self):
+    self.journal = Journal(os.path.join(getScriptDirectory(), "server.journal"))
+    records = self.journal.open()
+
+    if len(records):
+      self.journal_replaying = True
+      changed = journal.replay(self, records)
+      self.journal_replaying = False
+      for game in changed:
+        self.markGameDirty(game)
+      self.checkpointer.flush(self.serverDatabase)
+      self.journal.clear()
+      self.log.info('replayed {records} journal records, restoring {games} games', records = len(records), games = len(changed))
+
+    # sequence numbers need to keep growing, even if the journal is empty
+    self.journal.seq = max([self.journal.seq] + [g.journal_seq for g in self.getAllGames()])
+
+  def journalGame(self, game, code, **args):
+    if self.journal is None or self.journal_replaying:
+      return
+    game.journal_seq = self.journal.append(game.id, code, args)
+    if self.journal.size > JOURNAL_COMPACT_SIZE and not self.compacting_journal:
+      self.compactJournal()
+
+  # all records written so far can be dropped from the journal
+  # as soon as all games changed by them were saved
+  def compactJournal(self):
+    self.compacting_journal = True
+    offset = self.journal.size
+    d = self.checkpointer.requestCheckpoint()
+    d.addCallback(lambda _: self.journal.compact(offset))
+    d.addBoth(self.journalCompacted)
+
+  def journalCompacted(self, result):
+    self.compacting_journal = False
+    if isinstance(result, Failure):
+      self.log.failure('unable to compact journal', result)
+    else:
+      self.log.info('compacted journal to {size} bytes', size = self.journal.size)
+
+  # loads the card database file, doesn't need the reactor
+  @staticmethod
+  def readCardDatabase(path, archive_name):
+    card_database = CardDatabaseManager()
+    card_database.loadPath(path)
+    card_database.loadCards()
+
+    # keeping every version we ever served allows to send deltas
+    # to clients which cached an older one
+    if card_database.loaded:
+      card_database.archive(archive_name)
+
+    return card_database
+
+  # makes the given card database the one used for all new games
+  def useCardDatabase(self, card_database):
+    self.card_database = card_database
+    self.card_databases[card_database.hash] = card_database
+
+    self.black_cards = self.requested_black_cards
+    if self.card_database.black_card_count<self.black_cards:
+      self.black_cards = self.card_database.black_card_count
       self.log.info('database contains only {log_source.black_cards!r} black cards, reduced command-line argument to this amount')
     elif self.black_cards == -1:
-      self.black_cards = len(self.card_database.getBlackCards())
+      self.black_cards = self.card_database.black_card_count
+
+    # older versions won't be requested by clients anymore,
+    # unless a game is still played with them
+    for key in self.database_chunks.keys():
+      if key[0] not in self.card_databases:
+        del self.database_chunks[key]
+    for key in self.database_deltas.keys():
+      if key[1] not in self.card_databases:
+        del self.database_deltas[key]
+
+    # most clients will request a compressed database,
+    # so it can be prepared right away
+    self.chunkCardDatabase(card_database, 'zlib')
+
+  # returns the catalog of the card database with the given hash,
+  # as long as any game is still played with it, None otherwise
+  def getCardDatabase(self, hash):
+    return self.card_databases.get(hash)
+
+  # loads the card database file again in a separate thread and uses it
+  # for all new games, games already running keep their card database
+  # until they end
+  # returns a deferred firing with True if the card database changed
+  def reloadCardDatabase(self):
+    d = defer.Deferred()
+    if self.reloading is not None:
+      self.reloading.append(d)
+      return d
+    self.reloading = [d]
+    self.log.info('reloading card database')
+    r = threads.deferToThread(self.readCardDatabase, self.database_file, self.archive_name)
+    r.addCallback(self.swapCardDatabase)
+    r.addBoth(self.cardDatabaseReloaded)
+    return d
+
+  def swapCardDatabase(self, card_database):
+    if not card_database.loaded:
+      raise IOError('unable to open card database %s'%(self.database_file))
+
+    if card_database.hash == self.card_database.hash:
+      self.log.info('card database unchanged')
+      return False
+
+    self.useCardDatabase(card_database)
+    self.log.info('reloaded card database, {count} cards', count = len(card_database.cards))
+
+    for user in self.getAllUsers():
+      user.protocol.checkCardDatabase()
+
+    return True
+
+  def cardDatabaseReloaded(self, result):
+    waiting = self.reloading
+    self.reloading = None
+    if isinstance(result, Failure):
+      self.log.failure('unable to reload card database', result)
+    for d in waiting:
+      if isinstance(result, Failure):
+        d.errback(result)
+      else:
+        d.callback(result)
+
+  def startFactory(self):
+    self.useCardDatabase(self.readCardDatabase(self.database_file, self.archive_name))
 
     self.log.info("Loaded card database")
 
     self.openServerDatabase()
     self.loadGames()
+    self.replayJournal()
+    self.checkpointer.start()
+    self.spill_loop = task.LoopingCall(self.spillGames)
+    self.spill_loop.start(SPILL_INTERVAL, now = False)
 
     # after doing all the startup stuff
     self.log.info("Server up and running, waiting for incoming connections")
 
   def stopFactory(self):
+    cache = self.user_repository.cache
+    self.log.info('account cache answered {hits} of {lookups} lookups', hits = cache.hits, lookups = cache.hits + cache.misses)
+    self.checkpointer.stop()
+    if self.spill_loop is not None and self.spill_loop.running:
+      self.spill_loop.stop()
+    # waits for all queries still running, including a checkpoint
+    if self.database_pool.running:
+      self.database_pool.close()
     self.log.info('saving games...')
-    cursor = self.serverDatabase.cursor()
-    c = 0
-    for game in self.games:
-      if not game.open:
-        data = game.pack()
-        cursor.execute('INSERT INTO games ('+','.join(data.keys())+') VALUES ('+('?,'*len(data.keys()))[:-1]+')', tuple(data.values()))
-        c += 1
-    if c > 0:
-      self.serverDatabase.commit()
+    c = self.checkpointer.flush(self.serverDatabase)
     self.log.info('saved {count} games into database', count = c)
+    # everything the journal contains was saved right now
+    self.journal.clear()
+    self.journal.close()
+
+  # returns the path of the archived copy of the given card database
+  # the database file itself might have been replaced since loading it
+  def getCardDatabasePath(self, card_database):
+    return card_database.makePath(self.archive_name, card_database.hash)
+
+  # splits the given card database into chunks (see
+  # CardDatabaseManager.chunkFile()) in a separate thread,
+  # unless that already happened or is happening right now
+  def chunkCardDatabase(self, card_database, compression = None):
+    key = (card_database.hash, compression, )
+    if key in self.database_chunks or key in self.chunking_databases:
+      return
+    self.chunking_databases[key] = []
+    d = threads.deferToThread(CardDatabaseManager.chunkFile, self.getCardDatabasePath(card_database), compression)
+    d.addBoth(self.cardDatabaseChunked, key, card_database.size)
+
+  def cardDatabaseChunked(self, result, key, size):
+    if isinstance(result, Failure):
+      self.log.failure('unable to split card database into chunks', result)
+    else:
+      # the card database might have been reloaded in the meantime
+      if key[0] in self.card_databases:
+        self.database_chunks[key] = result
+      if key[1] is not None:
+        self.log.info('compressed card database from {size} to {compressed} bytes', size = size, compressed = len(result[0]))
+
+    for d in self.chunking_databases.pop(key):
+      if isinstance(result, Failure):
+        d.errback(result)
+      else:
+        d.callback(result)
+
+  # returns a deferred which fires with the given card database
+  # split into chunks, using the given compression
+  # every card database will only be processed once and cached afterwards
+  def getCardDatabaseChunks(self, card_database, compression = None):
+    key = (card_database.hash, compression, )
+    chunks = self.database_chunks.get(key)
+    if chunks is not None:
+      return defer.succeed(chunks)
+    self.chunkCardDatabase(card_database, compression)
+    d = defer.Deferred()
+    self.chunking_databases[key].append(d)
+    return d
+
+  # returns a deferred which fires with the delta from the first of the
+  # given card database versions still archived to the given card database,
+  # together with the hash of that version
+  # fires with None, None if none of them is available or a delta isn't
+  # worth it, since it would contain most cards anyway
+  # the archived version needs to be read from disk, so deltas will be
+  # computed in a separate thread and cached afterwards
+  def getCardDatabaseDelta(self, card_database, hashes):
+    for hash in hashes:
+      if hash == card_database.hash:
+        continue
+
+      key = (hash, card_database.hash, )
+
+      delta = self.database_deltas.pop(key, None)
+      if delta is not None:
+        self.database_deltas[key] = delta
+        return defer.succeed(self.checkCardDatabaseDelta(delta, card_database, hash))
+
+      if not os.path.exists(card_database.makePath(self.archive_name, hash)):
+        continue
+
+      if key not in self.computing_deltas:
+        self.computing_deltas[key] = []
+        d = threads.deferToThread(card_database.getDelta, self.archive_name, hash)
+        d.addBoth(self.cardDatabaseDeltaComputed, key)
+
+      d = defer.Deferred()
+      d.addCallback(self.checkCardDatabaseDelta, card_database, hash)
+      self.computing_deltas[key].append(d)
+      return d
+
+    return defer.succeed((None, None, ))
+
+  def cardDatabaseDeltaComputed(self, result, key):
+    if isinstance(result, Failure):
+      self.log.failure('unable to compute card database delta', result)
+      result = None
+    # the card database might have been reloaded in the meantime
+    elif result is not None and key[1] in self.card_databases:
+      self.database_deltas[key] = result
+      while len(self.database_deltas) > DELTA_CACHE_SIZE:
+        self.database_deltas.popitem(last = False)
+
+    for d in self.computing_deltas.pop(key):
+      d.callback(result)
+
+  @staticmethod
+  def checkCardDatabaseDelta(delta, card_database, hash):
+    if delta is None or len(delta['cards']) + len(delta['removed']) > len(card_database.cards) / 2:
+      return None, None
+    return hash, delta
+
+  # returns the url the given card database can be downloaded from,
+  # or None if it isn't served over http
+  # host is the address the client reached this server under
+  def getCardDatabaseURL(self, card_database, host):
+    if self.http_url is not None:
+      return '%s/%s'%(self.http_url.rstrip('/'), card_database.hash)
+    if self.http_port is not None:
+      return 'http://%s:%d/%s'%(host, self.http_port, card_database.hash)
+    return None
+
+  @property
+  def archive_name(self):
+    return os.path.basename(self.database_file)
 
   def createGame(self, name, password = None, rounds = None):
     game = Game.create(self, name = name, password_hash = password, rounds = rounds)
-    self.games.append(game)
+    self.addGame(game)
     return game
 
+  def addGame(self, game):
+    self.games[game.id] = game
+    self.game_names[game.name] = game
+    self.indexGame(game)
+
+  # replaces a game by its stub or the other way around
+  def replaceGame(self, old, new):
+    self.games[new.id] = new
+    if self.game_names.get(old.name) is old:
+      self.game_names[new.name] = new
+    self.indexGame(old)
+    self.indexGame(new)
+
   def unlinkGame(self, game):
-    del self.games[self.games.index(game)]
+    del self.games[game.id]
+    if self.game_names.get(game.name) is game:
+      del self.game_names[game.name]
+    self.indexGame(game)
+    self.markGameDirty(game)
+
+  # the game will be saved (or deleted from the server database)
+  # with the next checkpoint
+  def markGameDirty(self, game):
+    game.last_activity = time.time()
+    if self.checkpointer is not None:
+      self.checkpointer.markDirty(game)
+
+  # keeps the reverse index of paused game memberships up to date
+  # needs to be called whenever a game changes its open state or its users
+  def indexGame(self, game):
+    for id in self.game_members.pop(game, []):
+      games = self.paused_games[id]
+      games.discard(game)
+      if len(games) == 0:
+        del self.paused_games[id]
+
+    if game.open or self.games.get(game.id) is not game:
+      return
+
+    ids = game.players.keys()
+    self.game_members[game] = ids
+    for id in ids:
+      self.paused_games.setdefault(id, set()).add(game)
+
+  def getPausedGames(self, user_id):
+    return self.paused_games.get(user_id, set())
 
   def findGame(self, id):
-    possible_games = [g for g in self.games if g.id == id]
-    if len(possible_games) != 1:
-      return None
-    return possible_games[0]
+    return self.games.get(id)
 
-  def findUser(self, id):
-    possible_users = [u for u in self.users if u.id == id]
+  def addUser(self, user):
+    self.users[user] = user
 
-    if len(possible_users)!=1:
-      return None
+  # makes a logged in user available via findUser()
+  def indexUser(self, user):
+    self.user_ids[user.id] = user
+
+  def unlinkUser(self, user):
+    del self.users[user]
+    if self.user_ids.get(user.id) is user:
+      del self.user_ids[user.id]
 
-    return possible_users[0]
+  def findUser(self, id):
+    return self.user_ids.get(id)
 
   def getAllUsers(self):
-    return self.users
+    return self.users.values()
 
   def getAllGames(self):
-    return self.games
+    return self.games.values()
 
   def gameExists(self, name):
-    for game in self.games:
-      if game.name == name:
-        return True
-    return False
-
+    return name in self.game_names
@@ -1,36 +1,63 @@
-import copy
-import json
+from collections import deque
+import hashlib
+import itertools
 import random
+import time
 import uuid
 
 from twisted.logger import Logger
 
+from .deck import Deck
+from .player import Player
+from . import snapshot
 from . import version
+from shared.messages import *
 
 class Game(object):
   log = Logger()
+  # see GameStub
+  stub = False
 
   def __init__(self, factory):
     self.factory = factory
-    self.black_cards = []
+    self.black_cards = None
+    # the catalog of the card database this game is played with,
+    # see ServerFactory.getCardDatabase()
+    self.card_database = None
+    # maps the card ids of every choice made this turn to the related player
+    self.choices = {}
+    self.choices_remaining = 0
     self.database_hash = None
+    # the players which were joined when this game was saved,
+    # as (user id, chosen card ids) tuples, and whether it was running
+    # only needed when replaying the journal
+    self.interrupted_players = []
+    self.interrupted_running = False
+    # the sequence number of the last journal record of this game
+    self.journal_seq = 0
+    # the time this game changed the last time, see ServerFactory.spillGames()
+    self.last_activity = time.time()
     self.name = ''
     self.open = True
     self.password_hash = None
+    # user id -> player, the players themselves are stored in users
+    self.players = {}
     self.running = False
+    self.seed = None
     self.uuid = None
-    self.users = []
-    self.white_cards = []
+    # all players in order, the player at index 0 will always be the czar
+    self.users = deque()
+    self.white_cards = None
     self.rounds = 0
 
   @classmethod
   def create(cls, factory, name, password_hash = None, rounds = None):
     game = cls(factory)
-    game.database_hash = factory.card_database.hash
     game.name = name
     game.password_hash = password_hash
     game.uuid = uuid.uuid4()
     game.rounds = rounds
+    game.reseed(random.SystemRandom().getrandbits(63))
     game.loadCards()
 
     return game
@@ -42,38 +69,75 @@ class Game(object):
     game.password_hash = data['password_hash'] if len(data['password_hash']) else None
     game.open = False
     game.database_hash = data['database_hash']
+    game.card_database = factory.getCardDatabase(game.database_hash)
+    game.journal_seq = data.get('journal_seq') or 0
     game.uuid = uuid.UUID(data['id'])
 
-    game.users = json.loads(data['users'])
-    for user in game.users:
-      user['joined'] = False
-      user['chosen_cards'] = []
-      user['white_cards'] = [factory.card_database.getCard(c) for c in user['white_cards']]
+    users, cards = snapshot.unpackRow(data)
 
-    game.white_cards = [factory.card_database.getCard(c) for c in json.loads(data['cards'])['white_cards']]
-    game.black_cards = [factory.card_database.getCard(c) for c in json.loads(data['cards'])['black_cards']]
-    game.rounds = json.loads(data['cards'])['rounds']
+    for user in users:
+      game.addPlayer(Player.load(user, game.card_database))
+      if user.get('joined'):
+        game.interrupted_players.append((user['user'], user.get('chosen_cards', []), ))
+
+    game.interrupted_running = cards.get('running', False)
+    game.rounds = cards['rounds']
+    black_cards = game.card_database.black_cards
+    white_cards = game.card_database.white_cards
+
+    if 'seed' in cards:
+      game.reseed(cards['seed'])
+      game.black_cards = Deck.load(black_cards, game.seed, game.database_hash, cards['black_cards'], game.rounds)
+      game.white_cards = Deck.load(white_cards, game.seed, game.database_hash, cards['white_cards'])
+    else:
+      # games saved by older versions contain the complete remaining piles
+      # they will be drawn first, before continuing with a seeded deck
+      game.reseed(random.SystemRandom().getrandbits(63))
+      game.black_cards = Deck(black_cards, game.seed, game.database_hash, 0)
+      game.black_cards.putBack(cards['black_cards'])
+      game.white_cards = Deck(white_cards, game.seed, game.database_hash)
+      game.white_cards.putBack(cards['white_cards'])
 
     return game
 
+  # all randomness of a game is derived from its seed
+  # that way a game can be reproduced by knowing its seed only
+  def reseed(self, seed):
+    self.seed = seed
+
+  # returns a random generator for the given purpose, derived from the seed
+  # and the current round only (just like Deck.shuffle()), so a saved game
+  # will take the same decisions after loading it as it would have before
+  def getRandom(self, purpose):
+    seed = hashlib.sha256('%d:%s:%d:%d'%(self.seed, purpose, self.black_cards.epoch, self.black_cards.cursor)).hexdigest()
+    return random.Random(long(seed, 16))
+
+  # games switch to the current card database whenever they start all new,
+  # until then they keep the one they were created with
   def loadCards(self):
+    self.card_database = self.factory.card_database
+    self.database_hash = self.card_database.hash
+    black_cards = self.card_database.black_cards
+    white_cards = self.card_database.white_cards
 
-    if len(self.black_cards) == 0:
-      self.black_cards = self.factory.card_database.getBlackCards()
-      random.shuffle(self.black_cards)
+    self.rounds = min(len(black_cards), self.factory.black_cards, self.rounds if self.rounds is not None else len(black_cards))
 
-      self.rounds = min(len(self.black_cards), self.factory.black_cards, self.rounds if self.rounds is not None else len(self.black_cards))
-      self.black_cards = self.black_cards[:self.rounds]
+    self.black_cards = Deck(black_cards, self.seed, self.database_hash, self.rounds)
+    self.white_cards = Deck(white_cards, self.seed, self.database_hash)
 
-    if len(self.white_cards) == 0:
-      self.white_cards = self.factory.card_database.getWhiteCards()
+  # draws a white card which isn't held by any player yet
+  # the drawn card will be added to held
+  def drawWhiteCard(self, held):
+    card = self.white_cards.draw(held)
+    held.add(card)
+    return self.card_database.getCard(card)
 
-      # we need to strip all white cards users currently have in their pile
-      for user in self.users:
-        for card in user['white_cards']:
-          del self.white_cards[self.white_cards.index(card)]
+  def getHeldCards(self):
+    return set(c.id for p in self.users for c in p.white_cards)
 
-      random.shuffle(self.white_cards)
+  def addPlayer(self, player):
+    self.users.append(player)
+    self.players[player.user] = player
 
   def mayJoin(self, user):
 
@@ -87,13 +151,11 @@ class Game(object):
       return self.formatted(join = False, message = 'user already in this game')
 
     if self.open:
-      if len(self.users) + 1 > self.factory.card_database.max_players_per_game:
+      if len(self.users) + 1 > self.card_database.max_players_per_game:
         return self.formatted(join=False, message='no more players allowed')
       return self.formatted(join=True)
     else:
-      possible_users = [u for u in self.users if u['user'] == user.id]
-
-      if len(possible_users) != 1:
+      if self not in self.factory.getPausedGames(user.id):
         return self.formatted(join = False, message = 'you are no member of this paused game')
 
       return self.formatted(join = True)
@@ -106,17 +168,18 @@ class Game(object):
       return self.formatted(success=False, message='wrong password supplied')
 
     if self.open:
-      self.users.append(self.userdict(user, len(self.users) == 0))
+      self.addPlayer(Player(user.id, len(self.users) == 0))
       user.setGame(self)
     else:
-      possible_users = [u for u in self.users if u['user'] == user.id and not u['joined']]
-      possible_users[0]['joined'] = True
+      self.players[user.id].joined = True
       user.setGame(self)
+      self.factory.markGameDirty(self)
+      self.journal(MSG_JOIN_GAME, user_id = user.id)
 
     return self.formatted(success=True, game_id = self.id)
 
   def getAllUsers(self):
-    return [self.factory.findUser(u['user']) for u in self.users if u['joined']]
+    return [self.factory.findUser(p.user) for p in self.users if p.joined]
 
   def start(self):
     if len(self.getAllUsers())<3:
@@ -125,33 +188,56 @@ class Game(object):
     if self.running:
       return self.formatted(success=False, message='already running')
 
+    opened = self.open
+
     # if the game is currently open, we need to shuffle the users
     if self.open:
-      random.shuffle(self.users)
+      self.getRandom('users').shuffle(self.users)
       self.open = False
+      # the card database might have been reloaded since creating the game
+      # no cards were drawn yet, so it can still switch to the current one
+      if self.card_database is not self.factory.card_database:
+        self.loadCards()
 
     self.open = False
     self.running = True
+    self.factory.indexGame(self)
 
     # all users need to get 10 cards
-    for i in range(len(self.users)*10):
-      self.users[i/10]['white_cards'].append(self.white_cards[i])
-    self.white_cards=self.white_cards[len(self.users)*10:]
+    held = self.getHeldCards()
+    for player in self.users:
+      for i in range(10):
+        player.white_cards.append(self.drawWhiteCard(held))
 
     # determine the one with the black card
     # index at 0 will always be the czar
     # and black_cards 0 will always be the current black card
+    self.resetChoices()
+    self.factory.markGameDirty(self)
+
+    if opened:
+      # the journal doesn't know about games in the lobby,
+      # so it needs to get the whole game
+      self.journal(MSG_CREATE_GAME, **self.pack())
+    else:
+      self.journal(MSG_START_GAME)
 
     return self.formatted(success=True)
 
+  def resetChoices(self):
+    for player in self.users:
+      player.chosen_cards = []
+    self.choices = {}
+    self.choices_remaining = len(self.users) - 1
+
   def getCurrentBlackCard(self):
-    try:
-      return self.black_cards[0]
-    except IndexError:
+    card = self.black_cards.peek()
+    if card is None:
       return None
+    return self.card_database.getCard(card)
 
   def getAllWhiteCardsForUsers(self):
-    return [(self.factory.findUser(self.users[i]['user']), self.users[i]['white_cards']) for i in range(len(self.users))]
+    return [(self.factory.findUser(p.user), p.white_cards) for p in self.users]
 
   def suspend(self, user):
 
@@ -161,12 +247,13 @@ class Game(object):
       self.log.warn('user {user} not in game {game}', user = user.id, game = self.id)
       return
 
-    possible_users = [u for u in self.users if u['user'] == user.id and u['joined']]
-    if len(possible_users) != 1:
-      self.log.warn('found {count} users in game {game} while suspending due to user {user}', count = len(possible_users), game = self.id, user = user.id)
+    player = self.players.get(user.id)
+    if player is None or not player.joined:
+      self.log.warn('user {user} not found in game {game} while suspending', game = self.id, user = user.id)
     else:
-      possible_users[0]['joined'] = False
+      player.joined = False
       user.setGame(None)
+      self.journal(MSG_SUSPEND_GAME, user_id = user.id)
       self.log.info('user {user} suspended game {game}', user = user.id, game = self.id)
 
   def leave(self, user):
@@ -179,13 +266,17 @@ class Game(object):
       self.log.warn('no users in this game, {user} tried to leave', user = user.id)
       return self.formatted(success = False, message = 'no users found in this game')
 
-    possible_users = [u for u in self.users if u['user'] == user.id and u['joined']]
+    player = self.players.get(user.id)
 
-    if len(possible_users) != 1:
-      self.log.warn('{user} tried to leave game {game}, but found {count} possible users', user = user.id, game = self.id, count = len(possible_users))
+    if player is None or not player.joined:
+      self.log.warn('{user} tried to leave game {game}, but user not found', user = user.id, game = self.id)
       return self.formatted(success = False, message = 'unable to find user in this game')
 
-    del self.users[self.users.index(possible_users[0])]
+    if not self.open:
+      self.journal(MSG_LEAVE_GAME, user_id = user.id)
+
+    self.users.remove(player)
+    del self.players[user.id]
     user.setGame(None)
 
     self.log.info('user {user} left game {game}', user = user.id, game = self.id)
@@ -195,26 +286,30 @@ class Game(object):
     if len(self.users)<3 and not self.open:
       # this game will be opened up new soon
       # we will have to filter all users who aren't currently in here
-      self.users = [u for u in self.users if u['joined']]
+      for p in [p for p in self.users if not p.joined]:
+        self.users.remove(p)
+        del self.players[p.user]
 
       if len(self.users)>0 :
         self.open = True
-        for user in self.users:
-          user['white_cards'] = []
-          user['chosen_cards'] = []
-          user['black_cards'] = 0
-        self.white_cards = []
-        self.black_cards = []
+        for p in self.users:
+          p.white_cards = []
+          p.chosen_cards = []
+          p.black_cards = 0
+        self.reseed(self.getRandom('seed').getrandbits(63))
         self.loadCards()
 
-        if possible_users[0]['creator']:
-          for u in self.users:
-            if u != possible_users[0] and not u['creator']:
-              u['creator'] = True
+        if player.creator:
+          for p in self.users:
+            if not p.creator:
+              p.creator = True
               break
 
         self.log.info('not enough users left, game opened up all new')
 
+    self.factory.indexGame(self)
+    self.factory.markGameDirty(self)
+
     return self.formatted(success = True, unlinked = self.unlink())
 
   def pause(self):
@@ -226,15 +321,14 @@ class Game(object):
 
     self.running = False
 
-    for user in self.users:
-      user['chosen_cards'] = []
-      white_cards += user['white_cards']
-      user['white_cards'] = []
+    for player in self.users:
+      white_cards += [c.id for c in player.white_cards]
+      player.white_cards = []
 
-    white_cards += self.white_cards
+    self.resetChoices()
+    self.white_cards.putBack(white_cards)
+    self.factory.markGameDirty(self)
 
-    self.white_cards = white_cards
-      
     self.log.info('game {game} paused', game = self.id)
 
   def unlink(self, force = False):
@@ -243,6 +337,9 @@ class Game(object):
     if len(self.users)>0 and not force:
       return False
 
+    if force and not self.open:
+      self.journal(MSG_DELETE_GAME)
+
     self.factory.unlinkGame(self)
     self.log.info('game {game} deleted', game = self.id)
     return True
@@ -256,21 +353,23 @@ class Game(object):
     args['id'] = self.uuid.hex
     args['name'] = self.name
 
-    users = copy.deepcopy(self.users)
-    for user in users:
-      del user['joined']
-      del user['chosen_cards']
-      user['white_cards'] = [c.id for c in user['white_cards']]
-
-    args['users'] = json.dumps(users)
+    users = [p.pack() for p in self.users]
+    white_cards = self.white_cards.pack()
 
-    black_cards = [c.id for c in self.black_cards]
-    white_cards = [c.id for c in self.white_cards]
+    if self.running:
+      # running games will be saved just like pause() would leave them,
+      # so they can be continued after being loaded
+      held = []
+      for user in users:
+        held += user['white_cards']
+        user['white_cards'] = []
+      white_cards['returned'].extend(reversed(held))
 
-    args['cards'] = json.dumps({'white_cards': white_cards, 'black_cards': black_cards, 'rounds': self.rounds})
+    args['snapshot'] = buffer(snapshot.dumps(users, {'seed': self.seed, 'white_cards': white_cards, 'black_cards': self.black_cards.pack(), 'rounds': self.rounds, 'running': self.running}))
 
     args['password_hash'] = self.password_hash if self.protected else ''
     args['database_hash'] = self.database_hash
+    args['journal_seq'] = self.journal_seq
     args['server_version_major'] = version.MAJOR
     args['server_version_minor'] = version.MINOR
     args['server_version_revision'] = version.REVISION
@@ -278,110 +377,108 @@ class Game(object):
     return args
 
   def chooseCards(self, user, cards):
-    d = [u for u in self.users if u['user'] == user.id]
+    player = self.players.get(user.id)
 
-    if len(d) != 1:
+    if player is None:
       self.log.warn('user {user} wants to choose cards, but user not found in game {game}', user = user.id, game = self.id)
       return self.formatted(success = False, message = 'user not in this game')
 
-    d = d[0]
-
     for card in cards:
-      if not card in d['white_cards']:
+      if not card in player.white_cards:
         return self.formatted(success = False, message = 'user doesn\'t hold this card in his hand')
 
-    d['chosen_cards'] = cards
+    if len(player.chosen_cards) > 0:
+      del self.choices[tuple(c.id for c in player.chosen_cards)]
+    elif player is not self.users[0]:
+      self.choices_remaining -= 1
+
+    player.chosen_cards = cards
+    self.choices[tuple(c.id for c in cards)] = player
+
+    self.factory.markGameDirty(self)
+    self.journal(MSG_CHOOSE_CARDS, user_id = user.id, cards = [c.id for c in cards])
 
     return self.formatted(success = True)
 
   def getAllChoices(self):
     # returns all choices from all users, but in shuffled order (important)
-    choices = [u['chosen_cards'] for u in self.users if self.users.index(u)>0]
+    choices = [p.chosen_cards for p in itertools.islice(self.users, 1, None)]
 
-    random.shuffle(choices)
+    self.getRandom('choices').shuffle(choices)
 
     return choices
 
   def decide(self, cards):
 
     # let's see to which user those cards match
-    possible_users = [u for u in self.users if u['chosen_cards'] == cards]
-
-    if len(possible_users) != 1:
+    if None in cards:
       return self.formatted(success = False, message = "no user found with those cards")
 
-    # the user needs to gain one point
+    player = self.choices.get(tuple(c.id for c in cards))
 
-    user = possible_users[0]
+    if player is None:
+      return self.formatted(success = False, message = "no user found with those cards")
 
-    user['black_cards'] += 1
+    # the user needs to gain one point
+    player.black_cards += 1
 
     # as next we remove the current black card
-    del self.black_cards[0]
+    self.black_cards.draw()
 
     next_black_card = self.getCurrentBlackCard()
 
     # at next, all chosen cards must be removed from the user's white cards pile
     # and the chosen cards must be resetted
-    for u in self.users:
-      for card in u['chosen_cards']:
-        del u['white_cards'][u['white_cards'].index(card)]
-      u['chosen_cards'] = []
+    for p in self.users:
+      if len(p.chosen_cards) > 0:
+        chosen = set(p.chosen_cards)
+        p.white_cards = [c for c in p.white_cards if c not in chosen]
+    self.resetChoices()
 
     # we distribute new white cards to all users
     # all users need to get the same amount
-    for u in self.users:
-      if self.users.index(u) == 0:
-        continue # the czar didn't lose cards
+    held = self.getHeldCards()
+    for p in itertools.islice(self.users, 1, None): # the czar didn't lose cards
       for i in range(len(cards)):
-        if len(self.white_cards) == 0:
-          # we need to load the white cards pile all new
-          self.loadCards()
-
-        u['white_cards'].append(self.white_cards[0])
-        del self.white_cards[0]
+        p.white_cards.append(self.drawWhiteCard(held))
 
     # and of course the current czar must be moved to the end of the line
-    self.users.append(self.users[0])
-    del self.users[0]
+    self.users.rotate(-1)
 
     if next_black_card is None:
       # the game finished and we can reset it
       end = True
       self.open = True
       self.running = False
-      self.white_cards = []
-      self.black_cards = []
-      for u in self.users:
-        u['white_cards'] = []
-        u['black_cards'] = 0
+      for p in self.users:
+        p.white_cards = []
+        p.black_cards = 0
 
+      self.reseed(self.getRandom('seed').getrandbits(63))
       self.loadCards()
+      self.factory.indexGame(self)
 
     else:
       end = False
 
-    return self.formatted(success = True, winner = self.factory.findUser(user['user']), end = end)
+    self.factory.markGameDirty(self)
+    self.journal(MSG_CZAR_DECISION, cards = [c.id for c in cards])
+
+    return self.formatted(success = True, winner = self.factory.findUser(player.user), end = end)
+
+  # records a change of this game in the journal,
+  # so it can be replayed after a crash
+  def journal(self, code, **args):
+    self.factory.journalGame(self, code, **args)
 
   def isCreator(self, user):
 
-    possible_users = [u for u in self.users if u['user'] == user.id]
+    player = self.players.get(user.id)
 
-    if len(possible_users) == 0:
+    if player is None:
       return False
 
-    return possible_users[0]['creator']
-
-  @staticmethod
-  def userdict(user, creator):
-    return {
-            'user': user.id,
-            'joined': True,
-            'black_cards': 0,
-            'white_cards': [],
-            'chosen_cards': [],
-            'creator': creator
-           }
+    return player.creator
 
   @staticmethod
   def formatted(**kwargs):
@@ -396,9 +493,105 @@ class Game(object):
     return self.uuid.int
 
   @property
-  def choices_remaining(self):
-    return len([u for u in self.users if len(u['chosen_cards']) == 0 and self.users.index(u)>0])
+  def remaining_rounds(self):
+    return len(self.black_cards)
 
   @property
   def points(self):
-    return [(self.factory.findUser(u['user']), u['black_cards'], ) for u in self.users]
+    return [(self.factory.findUser(p.user), p.black_cards, ) for p in self.users]
+
+# stands in for a paused game which isn't loaded from the server database yet
+# (or was spilled back into it), holding just enough to list it in the lobby
+# the factory replaces it with the whole game as soon as somebody joins it
+class GameStub(object):
+  log = Logger()
+  open = False
+  running = False
+  stub = True
+
+  def __init__(self, factory):
+    self.factory = factory
+    # keeps the card database of the game loaded
+    self.card_database = None
+    self.database_hash = None
+    self.journal_seq = 0
+    self.name = ''
+    self.password_hash = None
+    # user id -> whether this user created the game
+    self.players = {}
+    self.remaining_rounds = 0
+    self.uuid = None
+
+  # only reads the columns needed for the lobby, see Game.load()
+  @classmethod
+  def load(cls, factory, **data):
+    stub = cls(factory)
+    stub.name = data['name']
+    stub.password_hash = data['password_hash'] if len(data['password_hash']) else None
+    stub.database_hash = data['database_hash']
+    stub.card_database = factory.getCardDatabase(stub.database_hash)
+    stub.journal_seq = data.get('journal_seq') or 0
+    stub.uuid = uuid.UUID(data['id'])
+
+    users, cards = snapshot.unpackRow(data)
+
+    for user in users:
+      stub.players[user['user']] = user['creator']
+
+    if 'seed' in cards:
+      stub.remaining_rounds = Deck.packedLength(cards['black_cards'], len(stub.card_database.black_cards), cards['rounds'])
+    else:
+      stub.remaining_rounds = len(cards['black_cards'])
+
+    return stub
+
+  @classmethod
+  def fromGame(cls, game):
+    stub = cls(game.factory)
+    stub.name = game.name
+    stub.password_hash = game.password_hash
+    stub.database_hash = game.database_hash
+    stub.card_database = game.card_database
+    stub.journal_seq = game.journal_seq
+    stub.uuid = game.uuid
+    stub.players = dict((p.user, p.creator, ) for p in game.users)
+    stub.remaining_rounds = game.remaining_rounds
+    return stub
+
+  def mayJoin(self, user):
+
+    if not self.factory.gameExists(self.name):
+      return self.formatted(join = False, message = "game doesn't exist anymore")
+
+    if self not in self.factory.getPausedGames(user.id):
+      return self.formatted(join = False, message = 'you are no member of this paused game')
+
+    return self.formatted(join = True)
+
+  # nobody joined a game which isn't loaded
+  def getAllUsers(self):
+    return []
+
+  def unlink(self, force = False):
+    if not force:
+      return False
+
+    self.factory.journalGame(self, MSG_DELETE_GAME)
+    self.factory.unlinkGame(self)
+    self.log.info('game {game} deleted', game = self.id)
+    return True
+
+  def isCreator(self, user):
+    return self.players.get(user.id, False)
+
+  @staticmethod
+  def formatted(**kwargs):
+    return kwargs
+
+  @property
+  def protected(self):
+    return self.password_hash != None
+
+  @property
+  def id(self):
+    return self.uuid.int
@@ -0,0 +1,288 @@
+import os
+import os.path
+import struct
+import zlib
+
+from twisted.internet import defer, reactor, threads
+from twisted.logger import Logger
+
+from shared.codec import decodeValue, decodeVarint, encodeValue, encodeVarint
+from shared.exceptions import CodecError
+from shared.messages import *
+
+# the journal will be compacted as soon as it grows beyond this size (bytes)
+JOURNAL_COMPACT_SIZE = 1024 * 1024
+
+# an append-only log of everything that happened to paused or running games
+# since they were saved into the server database the last time
+# every record consists of a sequence number, the game id, the message code
+# of the event and its arguments, encoded like binary messages
+# (see shared.codec) and followed by a crc32, so records torn apart by a
+# crash can be detected
+# records are collected and written once per reactor iteration
+# in a separate thread, followed by a single fsync
+class Journal(object):
+  log = Logger()
+
+  def __init__(self, path):
+    self.buffer = []
+    self.file = None
+    self.flush_call = None
+    # all writes to the file need to happen in order
+    self.lock = defer.DeferredLock()
+    self.path = path
+    # the highest sequence number handed out so far
+    self.seq = 0
+    # the size of the journal file, including records not written yet
+    self.size = 0
+
+  # reads all intact records, dropping any torn record at the end,
+  # and opens the journal for appending
+  # returns a list of (seq, game id, code, data) tuples
+  def open(self):
+    records = []
+    data = ''
+
+    if os.path.exists(self.path):
+      with open(self.path, 'rb') as file:
+        data = file.read()
+
+    buffer = bytearray(data)
+    offset = 0
+
+    while offset < len(buffer):
+      record = self.readRecord(buffer, offset)
+      if record is None:
+        self.log.warn('dropping {size} bytes of torn journal records', size = len(buffer) - offset)
+        break
+      offset, seq, game_id, code, args = record
+      records.append((seq, game_id, code, args, ))
+      self.seq = max(self.seq, seq)
+
+    self.file = open(self.path, 'ab')
+    self.file.truncate(offset)
+    self.size = offset
+
+    return records
+
+  @staticmethod
+  def readRecord(buffer, offset):
+    try:
+      length, start = decodeVarint(buffer, offset)
+      end = start + length
+      if end + 4 > len(buffer):
+        return None
+      if zlib.crc32(bytes(buffer[start:end])) & 0xffffffff != struct.unpack('>I', bytes(buffer[end:end + 4]))[0]:
+        return None
+      record, position = decodeValue(buffer, start)
+      seq, game_id, code, args = record
+    except (CodecError, IndexError, TypeError, ValueError):
+      return None
+    if position != end:
+      return None
+    return end + 4, seq, game_id, code, args
+
+  # appends a record, returning its sequence number
+  def append(self, game_id, code, args):
+    self.seq += 1
+
+    payload = bytearray()
+    encodeValue([self.seq, game_id, code, args], payload)
+    record = bytearray()
+    encodeVarint(len(payload), record)
+    record.extend(payload)
+    record.extend(struct.pack('>I', zlib.crc32(bytes(payload)) & 0xffffffff))
+
+    self.buffer.append(bytes(record))
+    self.size += len(record)
+
+    if self.flush_call is None:
+      self.flush_call = reactor.callLater(0, self.flush)
+
+    return self.seq
+
+  # writes all collected records
+  # returns a deferred firing as soon as they reached the disk
+  def flush(self):
+    if self.flush_call is not None:
+      if self.flush_call.active():
+        self.flush_call.cancel()
+      self.flush_call = None
+
+    if not len(self.buffer):
+      return defer.succeed(None)
+
+    data = ''.join(self.buffer)
+    self.buffer = []
+    d = self.lock.run(threads.deferToThread, self.write, data)
+    d.addErrback(self.writeFailed)
+    return d
+
+  def write(self, data):
+    self.file.write(data)
+    self.file.flush()
+    os.fsync(self.file.fileno())
+
+  def writeFailed(self, failure):
+    self.log.failure('unable to write journal', failure)
+
+  # drops the first offset bytes of the journal,
+  # once all records written before are done
+  def compact(self, offset):
+    self.flush()
+    self.size -= offset
+    d = self.lock.run(threads.deferToThread, self.truncate, offset)
+    d.addErrback(self.writeFailed)
+    return d
+
+  def truncate(self, offset):
+    temp_path = self.path + '.tmp'
+
+    with open(self.path, 'rb') as source, open(temp_path, 'wb') as target:
+      source.seek(offset)
+      for chunk in iter(lambda: source.read(65536), ''):
+        target.write(chunk)
+      target.flush()
+      os.fsync(target.fileno())
+
+    self.file.close()
+    # windows refuses to rename onto existing files
+    if os.name == 'nt':
+      os.remove(self.path)
+    os.rename(temp_path, self.path)
+    self.file = open(self.path, 'ab')
+
+  # writes everything synchronously and closes the journal,
+  # meant to be used when shutting down
+  def close(self):
+    if self.flush_call is not None and self.flush_call.active():
+      self.flush_call.cancel()
+    self.flush_call = None
+    if len(self.buffer):
+      self.write(''.join(self.buffer))
+      self.buffer = []
+    self.file.close()
+
+  # empties the journal synchronously, including all records
+  # not written yet, after all games were saved
+  def clear(self):
+    self.buffer = []
+    self.file.truncate(0)
+    self.file.flush()
+    os.fsync(self.file.fileno())
+    self.size = 0
+
+# stands in for the users of a game while replaying the journal,
+# since none of them are connected at that time
+class StandInUser(object):
+
+  def __init__(self, id):
+    self.game = None
+    self.id = id
+
+  def setGame(self, game):
+    self.game = game
+
+  def getGame(self):
+    return self.game
+
+# applies the journal records on top of the games loaded from the
+# server database, returning all games which were changed that way
+# afterwards, all games will look like every player suspended them,
+# just as they would be after shutting down properly
+def replay(factory, records):
+  users = {}
+  changed = set()
+  resumed = set()
+
+  def getUser(id):
+    if id not in users:
+      users[id] = StandInUser(id)
+    return users[id]
+
+  for seq, game_id, code, args in records:
+
+    game = factory.findGame(game_id)
+
+    if code == MSG_CREATE_GAME:
+      # a game which just left the lobby, saved as a whole
+      if game is not None and game.journal_seq >= seq:
+        continue
+      if args['database_hash'] != factory.card_database.hash:
+        continue
+      if game is not None:
+        factory.unlinkGame(game)
+      game = factory.loadGame(args)
+      game.journal_seq = seq
+      changed.add(game)
+      continue
+
+    if game is None or game.journal_seq >= seq:
+      continue
+
+    if game.stub:
+      game = factory.hydrateGame(game)
+      if game is None:
+        continue
+
+    changed.add(game)
+    if game not in resumed:
+      resumed.add(game)
+      resume(game, getUser)
+
+    if code == MSG_JOIN_GAME:
+      game.join(getUser(args['user_id']), game.password_hash)
+    elif code == MSG_START_GAME:
+      game.start()
+    elif code == MSG_CHOOSE_CARDS:
+      game.chooseCards(getUser(args['user_id']), game.card_database.getCards(args['cards']))
+    elif code == MSG_CZAR_DECISION:
+      game.decide(game.card_database.getCards(args['cards']))
+    elif code == MSG_SUSPEND_GAME:
+      game.suspend(getUser(args['user_id']))
+    elif code == MSG_LEAVE_GAME:
+      game.leave(getUser(args['user_id']))
+    elif code == MSG_DELETE_GAME:
+      game.unlink(True)
+
+    game.journal_seq = seq
+
+  for game in changed:
+    if factory.findGame(game.id) is not game:
+      continue
+    if game.open:
+      # nobody is left in the lobby after a restart
+      game.unlink(True)
+      continue
+    for player in list(game.users):
+      if player.joined:
+        game.suspend(getUser(player.user))
+
+  for game in factory.getAllGames():
+    if game.stub:
+      continue
+    game.interrupted_players = []
+    game.interrupted_running = False
+
+  return changed
+
+# the players of a game need to rejoin, and a running game needs to be
+# started again, so that all following records apply to the same state
+# starting deals the same hands again, since the game was saved
+# with them put back onto the deck
+def resume(game, getUser):
+  players = game.interrupted_players
+  game.interrupted_players = []
+
+  for id, chosen_cards in players:
+    game.join(getUser(id), game.password_hash)
+
+  if not game.interrupted_running:
+    return
+
+  game.interrupted_running = False
+  game.start()
+
+  for id, chosen_cards in players:
+    if len(chosen_cards):
+      game.chooseCards(getUser(id), game.card_database.getCards(chosen_cards))
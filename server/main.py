@@ -1,9 +1,12 @@
+import signal
 import sys
 from twisted.internet.endpoints import TCP4ServerEndpoint
 from twisted.internet import reactor
 from twisted.logger import globalLogBeginner, Logger, textFileLogObserver
+from twisted.web.server import Site
 
 from .argumentparser import ArgumentParser
+from .database_resource import CardDatabaseResource
 from .factory import ServerFactory
 from . import version
 from shared.path import getScriptDirectory
@@ -17,6 +20,19 @@ def main():
 
   log.info("Starting cards-against-humanity server version {major}.{minor}.{revision}", major=version.MAJOR, minor=version.MINOR, revision=version.REVISION)
 
+  factory = ServerFactory(parser.black_cards, parser.database, parser.http_port, parser.http_url, parser.checkpoint_interval, parser.admins)
+
   endpoint = TCP4ServerEndpoint(reactor, parser.port)
-  endpoint.listen(ServerFactory(parser.black_cards, parser.database))
+  endpoint.listen(factory)
+
+  if parser.http_port is not None:
+    # card database downloads don't need to share the game port that way
+    log.info("Serving card database over http on port {port}", port=parser.http_port)
+    endpoint = TCP4ServerEndpoint(reactor, parser.http_port)
+    endpoint.listen(Site(CardDatabaseResource(factory)))
+
+  # SIGHUP reloads the card database, failures are logged by the factory
+  if hasattr(signal, 'SIGHUP'):
+    signal.signal(signal.SIGHUP, lambda signum, frame: reactor.callFromThread(lambda: factory.reloadCardDatabase().addErrback(lambda failure: None)))
+
   reactor.run()
@@ -0,0 +1,33 @@
+# a single player taking part in a game
+# white_cards holds the cards in the player's hand,
+# black_cards the amount of black cards (points) won so far
+class Player(object):
+  __slots__ = ('black_cards', 'chosen_cards', 'creator', 'joined', 'user', 'white_cards')
+
+  def __init__(self, user, creator = False, joined = True):
+    self.black_cards = 0
+    self.chosen_cards = []
+    self.creator = creator
+    self.joined = joined
+    self.user = user
+    self.white_cards = []
+
+  # restores a player from the dict created by pack()
+  # the card database is needed to resolve the cards in the player's hand
+  @classmethod
+  def load(cls, data, card_database):
+    player = cls(data['user'], data['creator'], False)
+    player.black_cards = data['black_cards']
+    player.white_cards = card_database.getCards(data['white_cards'])
+    return player
+
+  # joined and chosen_cards are only needed when replaying the journal
+  def pack(self):
+    return {
+            'user': self.user,
+            'black_cards': self.black_cards,
+            'white_cards': [c.id for c in self.white_cards],
+            'creator': self.creator,
+            'joined': self.joined,
+            'chosen_cards': [c.id for c in self.chosen_cards]
+           }
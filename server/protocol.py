@@ -1,9 +1,14 @@
+from cStringIO import StringIO
+
 from .user import User
 from . import version
+from shared.card_database_manager import MAX_CARDS_PER_QUERY, TRANSFER_CHUNK_SIZE
+from shared.codec import selectCodec
 from shared.messages import *
 from shared.protocol import JSONReceiver
 
 class ServerProtocol(JSONReceiver):
+  coalesce_writes = True
 
   def __init__(self,factory):
     JSONReceiver.__init__(self, factory)
@@ -12,6 +17,11 @@ class ServerProtocol(JSONReceiver):
     self.addCallback(MODE_INITIAL_SYNC, MSG_DATABASE_QUERY, self.databaseQuery)
     self.addCallback(MODE_INITIAL_SYNC, MSG_DATABASE_PULL, self.databasePull)
     self.addCallback(MODE_INITIAL_SYNC, MSG_DATABASE_KNOWN, self.databaseKnown)
+    # clients will sync again after the card database got reloaded
+    for mode in (MODE_FREE_TO_JOIN, MODE_IN_GAME, ):
+      self.addCallback(mode, MSG_DATABASE_PULL, self.databasePull)
+      self.addCallback(mode, MSG_DATABASE_KNOWN, self.databaseKnown)
+      self.addCallback(mode, MSG_RELOAD_DATABASE, self.reloadDatabase)
     self.addCallback(MODE_FREE_TO_JOIN, MSG_CREATE_GAME, self.createGame)
     self.addCallback(MODE_FREE_TO_JOIN, MSG_JOIN_GAME, self.joinGame)
     self.addCallback(MODE_FREE_TO_JOIN, MSG_DELETE_GAME, self.deleteGame)
@@ -20,11 +30,18 @@ class ServerProtocol(JSONReceiver):
     self.addCallback(MODE_IN_GAME, MSG_CZAR_DECISION, self.czarDecision)
     self.addCallback(MODE_IN_GAME, MSG_SUSPEND_GAME, self.suspendGame)
     self.addCallback(MODE_IN_GAME, MSG_LEAVE_GAME, self.leaveGame)
+    self.addCallback(MODE_FREE_TO_JOIN, MSG_CARDS_QUERY, self.cardsQuery)
+    self.addCallback(MODE_IN_GAME, MSG_CARDS_QUERY, self.cardsQuery)
     self.setMode(MODE_CLIENT_AUTHENTIFICATION)
     self.user = User(self)
+    # the card database last offered to the client
+    self.card_database = None
+    self.http = False
 
   def connectionMade(self):
     self.identification = self.transport.getPeer().host
+    # all writes are coalesced already, so nagle's algorithm would only delay them
+    self.transport.setTcpNoDelay(True)
     self.log.info("{log_source.identification!r} established connection")
 
   def userAuthentification(self, username, password):
@@ -32,54 +49,206 @@ class ServerProtocol(JSONReceiver):
       self.log.warn('{log_source.identification!r} username or password with incorrect length specified')
       self.sendMessage(MSG_USER_LOGIN, success=False, message='invalid username or password specified')
       return
-    if not self.user.exists(username):
-      registration = True
-      result = self.user.register(username, password)
-      self.log.info('{log_source.identification!r} {message}', message=result['message'])
-      self.sendMessage(MSG_USER_REGISTRATION, **result)
-      if not result['success']:
-        self.transport.loseConnection()
-        return
-    result = self.user.login(username, password)
+    # no further messages will be accepted until the user database answered
+    self.setMode(MODE_NONE)
+    d = self.user.exists(username)
+    d.addCallback(self.userChecked, username, password)
+    d.addErrback(self.userAuthentificationFailed)
+
+  def userChecked(self, exists, username, password):
+    if exists:
+      return self.loginUser(username, password)
+    d = self.user.register(username, password)
+    d.addCallback(self.userRegistered, username, password)
+    return d
+
+  def userRegistered(self, result, username, password):
+    self.log.info('{log_source.identification!r} {message}', message=result['message'])
+    self.sendMessage(MSG_USER_REGISTRATION, **result)
+    if not result['success']:
+      self.loseConnection()
+      return
+    return self.loginUser(username, password)
+
+  def loginUser(self, username, password):
+    d = self.user.login(username, password)
+    d.addCallback(self.userLoggedIn)
+    return d
+
+  def userLoggedIn(self, result):
     if result['success']:
       self.identification = self.user.name
       self.setMode(MODE_INITIAL_SYNC)
-      for user in self.factory.getAllUsers():
-        if user is not self.user:
-          user.protocol.sendMessage(MSG_LOGGED_IN, user_id = self.user.id, user_name = self.user.name)
+      self.broadcastMessage([u.protocol for u in self.factory.getAllUsers() if u is not self.user], MSG_LOGGED_IN, user_id = self.user.id, user_name = self.user.name)
 
     self.log.info('{log_source.identification!r} {message}', message=result['message'])
     self.sendMessage(MSG_USER_LOGIN, **result)
     if not result['success']:
-      self.transport.loseConnection()
+      self.loseConnection()
     else:
       users = [{'id': u.id, 'name': u.name} for u in self.factory.getAllUsers() if u.id != self.user.id]
       self.sendMessage(MSG_CURRENT_USERS, users = users)
-      games = [{'id': g.id, 'name': g.name, 'creator': g.isCreator(self.user), 'users': len(g.getAllUsers()), 'rounds': len(g.black_cards), 'protected': g.protected} for g in self.factory.getAllGames() if g.mayJoin(self.user)['join']]
+      games = [{'id': g.id, 'name': g.name, 'creator': g.isCreator(self.user), 'users': len(g.getAllUsers()), 'rounds': g.remaining_rounds, 'protected': g.protected} for g in self.factory.getAllGames() if g.mayJoin(self.user)['join']]
       self.sendMessage(MSG_CURRENT_GAMES, games = games)
 
-  def clientAuthentification(self, major, minor, revision):
+  def userAuthentificationFailed(self, failure):
+    self.log.failure('{log_source.identification!r} unable to access user database', failure)
+    self.sendMessage(MSG_USER_LOGIN, success=False, message='internal server error')
+    self.loseConnection()
+
+  # codecs contains the names of all codecs supported by the client
+  # older clients don't send any and will keep using json
+  def clientAuthentification(self, major, minor, revision, codecs = None):
     self.log.info('{log_source.identification!r} using client version {major}.{minor}.{revision}', major=major, minor=minor, revision=revision)
     if major < version.MAJOR or minor < version.MINOR:
       self.log.info('incompatible client version, connection refused')
       self.sendMessage(MSG_CLIENT_REFUSED, reason='incompatible client and server versions')
-      self.transport.loseConnection()
-    else:
+      self.loseConnection()
+    elif codecs is None:
       self.sendMessage(MSG_CLIENT_ACCEPTED)
       self.setMode(MODE_USER_AUTHENTIFICATION)
+    else:
+      codec = selectCodec(codecs)
+      self.log.info('{log_source.identification!r} using codec {codec}', codec = codec.name)
+      # the acceptance itself will still be sent using json
+      self.sendMessage(MSG_CLIENT_ACCEPTED, codec = codec.name)
+      self.setCodec(codec.name)
+      self.setMode(MODE_USER_AUTHENTIFICATION)
+
+  # clients supporting http downloads will be told where to find the database
+  def databaseQuery(self, http = False):
+    self.card_database = self.getCardDatabase()
+    self.http = http
+    url = self.factory.getCardDatabaseURL(self.card_database, self.transport.getHost().host) if http else None
+    if url is None:
+      self.sendMessage(MSG_DATABASE_QUERY, hash=self.card_database.hash)
+    else:
+      self.sendMessage(MSG_DATABASE_QUERY, hash=self.card_database.hash, url=url)
+
+  # players of a game need the card database it is played with,
+  # everyone else the current one
+  def getCardDatabase(self):
+    game = self.user.getGame()
+    if game is not None:
+      return game.card_database
+    return self.factory.card_database
+
+  # compression contains the compression methods supported by the client
+  # known contains the hashes of older card databases cached by the client
+  # offset is the amount of bytes the client already downloaded
+  # clients which don't send an offset don't support chunked transfers
+  def databasePull(self, compression = None, known = None, offset = None):
+    if known is not None:
+      d = self.factory.getCardDatabaseDelta(self.card_database, known)
+      d.addCallback(self.sendDatabaseDelta, self.card_database, known, compression, offset)
+      return
+
+    self.sendDatabaseTransfer(compression, offset)
+
+  def sendDatabaseDelta(self, result, card_database, known, compression, offset):
+    # clients offered another card database in the meantime will pull again
+    if self.transport.disconnecting or card_database is not self.card_database:
+      return
+
+    hash, delta = result
+    if delta is None:
+      self.sendDatabaseTransfer(compression, offset)
+      return
+
+    self.log.info("{log_source.identification!r} requests card database, sending {cards} changed and {removed} removed cards", cards = len(delta['cards']), removed = len(delta['removed']))
+    self.sendSplitMessage(MSG_DATABASE_DELTA, ('cards', 'removed', ), base = known.index(hash), **delta)
+
+  def sendDatabaseTransfer(self, compression, offset):
+    if offset is None:
+      self.log.info("{log_source.identification!r} requests card database")
+      self.sendDatabase()
+      return
+
+    self.log.info("{log_source.identification!r} requests card database, starting at byte {offset}", offset = offset)
+
+    if compression is not None and 'zlib' in compression:
+      compression = 'zlib'
+    else:
+      compression = None
+
+    d = self.factory.getCardDatabaseChunks(self.card_database, compression)
+    d.addCallbacks(self.sendDatabaseChunks, self.sendDatabase, callbackArgs = (compression, offset, ))
+
+  def sendDatabase(self, failure = None):
+    if self.transport.disconnecting:
+      return
+    self.sendMessage(MSG_DATABASE_PUSH, size=self.card_database.size)
+    self.sendFile(open(self.factory.getCardDatabasePath(self.card_database), 'rb'))
+
+  def sendDatabaseChunks(self, transfer, compression, offset):
+    if self.transport.disconnecting:
+      return
+
+    compressed, chunks = transfer
 
-  def databaseQuery(self):
-    self.sendMessage(MSG_DATABASE_QUERY, hash=self.factory.card_database.hash)
+    # transfers can only be resumed at the beginning of a chunk
+    if offset % TRANSFER_CHUNK_SIZE != 0 or offset // TRANSFER_CHUNK_SIZE > len(chunks):
+      offset = 0
 
-  def databasePull(self):
-    self.log.info("{log_source.identification!r} requests card database")
-    self.sendMessage(MSG_DATABASE_PUSH, size=self.factory.card_database.size)
-    self.sendRawData(self.factory.card_database.data)
+    index = offset // TRANSFER_CHUNK_SIZE
+    skip = sum(c[0] for c in chunks[:index])
+
+    if compressed is None:
+      file = open(self.factory.getCardDatabasePath(self.card_database), 'rb')
+    else:
+      file = StringIO(compressed)
+    file.seek(skip)
+
+    # large card databases consist of more chunks than a single message can list
+    self.sendSplitMessage(MSG_DATABASE_PUSH, ('chunks', ), size = sum(c[0] for c in chunks[index:]), compression = compression, offset = offset, chunks = chunks[index:])
+    self.sendFile(file)
 
   def databaseKnown(self):
-    self.log.info("{log_source.identification!r} knows current card database")
+    self.log.info("{log_source.identification!r} knows card database")
     self.sendMessage(MSG_SYNC_FINISHED)
-    self.setMode(MODE_FREE_TO_JOIN)
+    if self.getMode() == MODE_INITIAL_SYNC:
+      self.setMode(MODE_FREE_TO_JOIN)
+    # the card database might have been reloaded while syncing
+    self.checkCardDatabase()
+
+  # offers the card database needed right now (see getCardDatabase())
+  # to clients which synced another one, e.g. after reloading it,
+  # joining a game still played with an older one or leaving such a game
+  # all messages sent afterwards will already refer to that card database
+  def checkCardDatabase(self):
+    if not self.transport.connected or self.getMode() not in (MODE_FREE_TO_JOIN, MODE_IN_GAME, ):
+      return
+    if self.card_database is None or self.card_database.hash == self.getCardDatabase().hash:
+      return
+    self.log.info("{log_source.identification!r} offered card database {hash}", hash = self.getCardDatabase().hash[:8])
+    self.databaseQuery(self.http)
+
+  # only users named on the command line may reload the card database
+  def reloadDatabase(self):
+    if self.user.name not in self.factory.admins:
+      self.log.warn("{log_source.identification!r} tried to reload the card database")
+      self.sendMessage(MSG_RELOAD_DATABASE, success = False, message = 'you are not allowed to reload the card database')
+      return
+    d = self.factory.reloadCardDatabase()
+    d.addCallbacks(self.databaseReloaded, self.databaseReloadFailed)
+
+  def databaseReloaded(self, changed):
+    if self.transport.connected:
+      self.sendMessage(MSG_RELOAD_DATABASE, success = True, message = 'card database reloaded' if changed else 'card database unchanged')
+
+  def databaseReloadFailed(self, failure):
+    if self.transport.connected:
+      self.sendMessage(MSG_RELOAD_DATABASE, success = False, message = 'unable to reload card database')
+
+  # lazy clients fetch the cards they need by id
+  # players of a game get the cards of the card database it is played with
+  # long card texts might need the answer to be split into several messages
+  def cardsQuery(self, ids):
+    if len(ids) > MAX_CARDS_PER_QUERY:
+      self.log.warn('{log_source.identification!r} requested {count} cards at once', count = len(ids))
+      ids = ids[:MAX_CARDS_PER_QUERY]
+    cards = self.getCardDatabase().getCards(ids)
+    self.sendSplitMessage(MSG_CARDS, ('cards', ), cards = [[c.id, c.text, c.type] for c in cards if c is not None])
 
   def createGame(self, game_name, game_password = None, rounds = None):
     if len(game_name)==0 or len(game_name)>30 or (game_password is not None and len(game_password)!=128):
@@ -106,8 +275,7 @@ class ServerProtocol(JSONReceiver):
     game = self.factory.createGame(game_name, game_password, rounds)
     self.log.info("{log_source.identification!r} created new game {name} with id {id}", name=game_name, id = game.id)
 
-    for user in self.factory.getAllUsers():
-      user.protocol.sendMessage(MSG_CREATE_GAME, game_id = game.id, name = game_name, creator = game.isCreator(user), rounds = len(game.black_cards), protected = game.protected)
+    self.broadcastMessage([u.protocol for u in self.factory.getAllUsers()], MSG_CREATE_GAME, overlay = lambda p: {'creator': game.isCreator(p.user)}, game_id = game.id, name = game_name, rounds = game.remaining_rounds, protected = game.protected)
 
     self.joinGame(game.id, game_password)
 
@@ -118,6 +286,12 @@ class ServerProtocol(JSONReceiver):
       self.log.warn("{log_source.identification!r} tried to join non-existant game")
       return
 
+    if game.stub:
+      # the game needs to be loaded from the server database first
+      d = self.factory.requestGame(game)
+      d.addCallbacks(self.gameLoaded, self.gameLoadFailed, callbackArgs = (game_id, game_password, ))
+      return
+
     joinable = {}
     for user in self.factory.getAllUsers():
       joinable[user] = game.mayJoin(user)['join'] or user.getGame() == game
@@ -130,15 +304,29 @@ class ServerProtocol(JSONReceiver):
       self.log.info("{log_source.identification!r} joined game {id}", id = game.id)
       self.setMode(MODE_IN_GAME)
 
-      for user in self.factory.getAllUsers():
-        if joinable[user]:
-          if user is not self.user:
-            user.protocol.sendMessage(MSG_JOIN_GAME, user_id = self.user.id, game_id = game.id)
-          else:
-            user.protocol.sendMessage(MSG_JOIN_GAME, users = [u.id for u in game.getAllUsers() if u != self.user], user_id = self.user.id, game_id = game.id)
+      users = self.factory.getAllUsers()
+
+      self.broadcastMessage([u.protocol for u in users if joinable[u] and u is not self.user], MSG_JOIN_GAME, user_id = self.user.id, game_id = game.id)
+      self.sendMessage(MSG_JOIN_GAME, users = [u.id for u in game.getAllUsers() if u != self.user], user_id = self.user.id, game_id = game.id)
+
+      # the game might still be played with an older card database
+      self.checkCardDatabase()
 
-        if joinable[user] != (game.mayJoin(user)['join'] or user.getGame() == game):
-          user.protocol.sendMessage(MSG_DELETE_GAME, game_id = game.id)
+      self.broadcastMessage([u.protocol for u in users if joinable[u] != (game.mayJoin(u)['join'] or u.getGame() == game)], MSG_DELETE_GAME, game_id = game.id)
+
+  def gameLoaded(self, game, game_id, game_password):
+    # the user might have done something else in the meantime
+    if not self.transport.connected or self.getMode() != MODE_FREE_TO_JOIN:
+      return
+    # the game got deleted while it was loaded
+    if game is None:
+      self.sendMessage(MSG_JOIN_GAME, success = False, message = "game doesn't exist anymore")
+      return
+    self.joinGame(game_id, game_password)
+
+  def gameLoadFailed(self, failure):
+    if self.transport.connected:
+      self.sendMessage(MSG_JOIN_GAME, success = False, message = 'internal server error')
 
   def startGame(self):
     game = self.user.getGame()
@@ -156,12 +344,14 @@ class ServerProtocol(JSONReceiver):
     if not result['success']:
       return
 
+    # games which didn't start yet switch to the current card database,
+    # so their players need to know it before getting any cards
     for user in game.getAllUsers():
-      user.protocol.sendMessage(MSG_STARTED_GAME, user_id = self.user.id, points = [[p[0].id, p[1]] for p in game.points])
+      user.protocol.checkCardDatabase()
 
-    for user in self.factory.getAllUsers():
-      if joinable[user] != (game.mayJoin(user)['join'] or user.getGame() == game):
-        user.protocol.sendMessage(MSG_DELETE_GAME, game_id = game.id)
+    self.broadcastMessage([u.protocol for u in game.getAllUsers()], MSG_STARTED_GAME, user_id = self.user.id, points = [[p[0].id, p[1]] for p in game.points])
+
+    self.broadcastMessage([u.protocol for u in self.factory.getAllUsers() if joinable[u] != (game.mayJoin(u)['join'] or u.getGame() == game)], MSG_DELETE_GAME, game_id = game.id)
 
     self.sendTurnStarted()
 
@@ -173,23 +363,21 @@ class ServerProtocol(JSONReceiver):
       self.sendMessage(MSG_CHOOSE_CARDS, success = False, message = 'invalid amount of cards selected')
       return
 
-    result = game.chooseCards(self.user, [self.factory.card_database.getCard(c) for c in cards])
+    result = game.chooseCards(self.user, game.card_database.getCards(cards))
 
     if not result['success']:
       self.log.info('{log_source.identification!r} unable to choose cards: {message}', message = result['message'])
       self.sendMessage(MSG_CHOOSE_CARDS, **result)
       return
 
-    for user in game.getAllUsers():
-      user.protocol.sendMessage(MSG_CHOOSE_CARDS, user_id = self.user.id)
+    self.broadcastMessage([u.protocol for u in game.getAllUsers()], MSG_CHOOSE_CARDS, user_id = self.user.id)
 
     # maybe we already got all choices and can send them to the players
     if game.choices_remaining == 0:
     
       choices = [[c.id for c in o] for o in game.getAllChoices()]
 
-      for user in game.getAllUsers():
-        user.protocol.sendMessage(MSG_CHOICES, choices = choices)
+      self.broadcastMessage([u.protocol for u in game.getAllUsers()], MSG_CHOICES, choices = choices)
 
   def czarDecision(self, cards):
 
@@ -200,14 +388,13 @@ class ServerProtocol(JSONReceiver):
       self.sendMessage(MSG_CZAR_DECISION, success = False, message = "you aren't the czar")
       return
 
-    result = game.decide([self.factory.card_database.getCard(c) for c in cards])
+    result = game.decide(game.card_database.getCards(cards))
 
     if not result['success']:
       self.sendMessage(MSG_CZAR_DECISION, **result)
       return
 
-    for user in game.getAllUsers():
-      user.protocol.sendMessage(MSG_CZAR_DECISION, winner = result['winner'].id, end = result['end'], rounds = len(game.black_cards))
+    self.broadcastMessage([u.protocol for u in game.getAllUsers()], MSG_CZAR_DECISION, winner = result['winner'].id, end = result['end'], rounds = game.remaining_rounds)
 
     if not result['end']:
       self.sendTurnStarted()
@@ -230,16 +417,16 @@ class ServerProtocol(JSONReceiver):
       code = MSG_SUSPEND_GAME
       game.suspend(self.user)
 
-    for user in self.factory.getAllUsers():
-      if joinable[user]:
-        user.protocol.sendMessage(code, user_id = self.user.id, game_id = game.id)
-      if len(game.users) == 0 and game.open:
-        user.protocol.sendMessage(MSG_DELETE_GAME, game_id = game.id)
-      else:
-        if joinable[user] != (game.mayJoin(user)['join'] or user.getGame() == game):
-          user.protocol.sendMessage(MSG_CREATE_GAME, game_id = game.id, name = game.name, creator = game.isCreator(user), rounds = len(game.black_cards), protected = game.protected)
+    users = self.factory.getAllUsers()
+
+    self.broadcastMessage([u.protocol for u in users if joinable[u]], code, user_id = self.user.id, game_id = game.id)
+    if len(game.users) == 0 and game.open:
+      self.broadcastMessage([u.protocol for u in users], MSG_DELETE_GAME, game_id = game.id)
+    else:
+      self.broadcastMessage([u.protocol for u in users if joinable[u] != (game.mayJoin(u)['join'] or u.getGame() == game)], MSG_CREATE_GAME, overlay = lambda p: {'creator': game.isCreator(p.user)}, game_id = game.id, name = game.name, rounds = game.remaining_rounds, protected = game.protected)
 
     self.setMode(MODE_FREE_TO_JOIN)
+    self.checkCardDatabase()
 
   def leaveGame(self):
 
@@ -262,15 +449,16 @@ class ServerProtocol(JSONReceiver):
 
     self.setMode(MODE_FREE_TO_JOIN)
 
-    for user in self.factory.getAllUsers():
-      if joinable[user]:
-        user.protocol.sendMessage(MSG_LEAVE_GAME, game_id = game.id, user_id = self.user.id)
+    users = self.factory.getAllUsers()
+
+    self.broadcastMessage([u.protocol for u in users if joinable[u]], MSG_LEAVE_GAME, game_id = game.id, user_id = self.user.id)
+
+    if result['unlinked']:
+      self.broadcastMessage([u.protocol for u in users], MSG_DELETE_GAME, game_id = game.id)
+    else:
+      self.broadcastMessage([u.protocol for u in users if joinable[u] != (game.mayJoin(u)['join'] or u.getGame() == game)], MSG_CREATE_GAME, overlay = lambda p: {'creator': game.isCreator(p.user)}, game_id = game.id, name = game.name, rounds = game.remaining_rounds, protected = game.protected)
 
-      if result['unlinked']:
-        user.protocol.sendMessage(MSG_DELETE_GAME, game_id = game.id)
-      else:
-        if joinable[user] != (game.mayJoin(user)['join'] or user.getGame() == game):
-          user.protocol.sendMessage(MSG_CREATE_GAME, game_id = game.id, name = game.name, creator = game.isCreator(user), rounds = len(game.black_cards), protected = game.protected)
+    self.checkCardDatabase()
 
   def deleteGame(self, game_id):
 
@@ -295,17 +483,16 @@ class ServerProtocol(JSONReceiver):
 
     game.unlink(True)
 
-    for user in self.factory.getAllUsers():
-      if joinable[user]:
-        user.protocol.sendMessage(MSG_DELETE_GAME, game_id = game.id)
+    self.broadcastMessage([u.protocol for u in self.factory.getAllUsers() if joinable[u]], MSG_DELETE_GAME, game_id = game.id)
 
   def connectionLost(self, reason):
+    JSONReceiver.connectionLost(self, reason)
     self.log.info('{log_source.identification!r} lost connection')
     self.log.debug(reason.getErrorMessage())
+    self.log.debug('{log_source.identification!r} sent {messages} messages within {flushes} writes ({log_source.messages_per_flush:.2f} messages per write)', messages = self.flushed_messages, flushes = self.flushes)
     self.suspendGame()
     self.user.unlink()
-    for user in self.factory.getAllUsers():
-      user.protocol.sendMessage(MSG_LOGGED_OFF, user_id = self.user.id)
+    self.broadcastMessage([u.protocol for u in self.factory.getAllUsers()], MSG_LOGGED_OFF, user_id = self.user.id)
 
   def sendTurnStarted(self):
     game = self.user.getGame()
@@ -315,5 +502,6 @@ class ServerProtocol(JSONReceiver):
 
     for pair in pairs:
       pair[0].protocol.sendMessage(MSG_DRAW_CARDS, cards = [c.id for c in pair[1]])
-      pair[0].protocol.sendMessage(MSG_CZAR_CHANGE, user_id = pairs[0][0].id, card = black_card.id)
+
+    self.broadcastMessage([p[0].protocol for p in pairs], MSG_CZAR_CHANGE, user_id = pairs[0][0].id, card = black_card.id)
 
@@ -0,0 +1,117 @@
+import sqlite3
+
+from twisted.enterprise import adbapi
+from twisted.logger import Logger
+
+from . import snapshot
+
+log = Logger()
+
+# converts the json saved by older versions into snapshots,
+# see snapshot.py
+# games which can't be converted will be deleted
+def convertGames(connection):
+  rows = connection.execute("SELECT rowid, users, cards FROM 'games' WHERE snapshot IS NULL").fetchall()
+  for rowid, users, cards in rows:
+    try:
+      data = snapshot.convertRow(users, cards)
+    except (KeyError, TypeError, ValueError):
+      log.warn('deleting game {rowid} which cannot be converted', rowid = rowid)
+      connection.execute("DELETE FROM 'games' WHERE rowid = ?", (rowid, ))
+      continue
+    connection.execute("UPDATE 'games' SET snapshot = ?, users = NULL, cards = NULL WHERE rowid = ?", (buffer(data), rowid, ))
+
+# the schema of the server database is changed by migrations only
+# every migration is a list of statements (or functions receiving the
+# connection), applied within a single
+# transaction together with raising the user_version of the database
+# to its position within this list (starting at 1)
+# migrations may only be appended, never changed, otherwise existing
+# databases won't be brought to the same schema as new ones
+MIGRATIONS = [
+  # the initial schema, databases created before the migrations
+  # were introduced already contain these tables
+  [
+    "CREATE TABLE IF NOT EXISTS 'users' ('id' INTEGER PRIMARY KEY, 'name' VARCHAR(30), 'password' CHAR(128))",
+    "CREATE TABLE IF NOT EXISTS 'games' ('id' CHAR(32), 'name' VARCHAR(30), 'users' TEXT, 'cards' TEXT, 'password_hash' CHAR(128), 'database_hash' CHAR(128), 'server_version_major' TINYINT, 'server_version_minor' TINYINT, 'server_version_revision' TINYINT)",
+  ],
+  # every login looks users up by name,
+  # games are loaded by card database and server version
+  [
+    "CREATE INDEX IF NOT EXISTS 'users_name' ON 'users' ('name')",
+    "CREATE INDEX IF NOT EXISTS 'games_version' ON 'games' ('database_hash', 'server_version_major', 'server_version_minor')",
+  ],
+  # games are saved by replacing their previous row
+  [
+    "DELETE FROM 'games' WHERE rowid NOT IN (SELECT max(rowid) FROM 'games' GROUP BY id)",
+    "CREATE UNIQUE INDEX IF NOT EXISTS 'games_id' ON 'games' ('id')",
+  ],
+  # the journal record each game was saved at, see journal.py
+  [
+    "ALTER TABLE 'games' ADD COLUMN 'journal_seq' INTEGER NOT NULL DEFAULT 0",
+  ],
+  # games are saved as binary snapshots instead of json
+  [
+    "ALTER TABLE 'games' ADD COLUMN 'snapshot' BLOB",
+    convertGames,
+  ],
+]
+
+# the page cache size of every connection, in kilobytes
+CACHE_SIZE = 8192
+
+# needs to be applied to every connection opened to the server database
+# commits are only synced to disk at checkpoints when using a write-ahead log,
+# which might lose the latest commits on power loss, but never corrupts
+# the database
+def configureConnection(connection):
+  connection.execute('PRAGMA synchronous = NORMAL')
+  connection.execute('PRAGMA cache_size = -%d'%(CACHE_SIZE))
+
+# opens the server database, bringing its schema up to date
+def openDatabase(path):
+  connection = sqlite3.connect(path)
+  # readers and the writer won't block each other with a write-ahead log,
+  # the journal mode is stored within the database itself
+  connection.execute('PRAGMA journal_mode = WAL')
+  configureConnection(connection)
+  migrate(connection)
+  return connection
+
+# opens a pool of connections to the already migrated server database,
+# used to access it without blocking the reactor
+# the database uses a write-ahead log, so reads can run in parallel
+def openPool(path):
+  return adbapi.ConnectionPool('sqlite3', path, check_same_thread = False, cp_min = 1, cp_max = 3, cp_openfun = configureConnection)
+
+def migrate(connection):
+  version = connection.execute('PRAGMA user_version').fetchone()[0]
+
+  if version > len(MIGRATIONS):
+    raise sqlite3.DatabaseError('server database version %d is newer than the supported version %d'%(version, len(MIGRATIONS)))
+
+  if version == len(MIGRATIONS):
+    return
+
+  # the sqlite3 module would commit implicitly before every schema change,
+  # so transactions need to be handled manually instead
+  isolation_level = connection.isolation_level
+  connection.isolation_level = None
+
+  try:
+    for version in range(version + 1, len(MIGRATIONS) + 1):
+      connection.execute('BEGIN')
+      try:
+        for statement in MIGRATIONS[version - 1]:
+          if callable(statement):
+            statement(connection)
+          else:
+            connection.execute(statement)
+        connection.execute('PRAGMA user_version = %d'%(version))
+        connection.execute('COMMIT')
+      except:
+        connection.execute('ROLLBACK')
+        raise
+      log.info('migrated server database to version {version}', version = version)
+  finally:
+    connection.isolation_level = isolation_level
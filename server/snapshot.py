@@ -0,0 +1,124 @@
+from array import array
+import json
+import sys
+
+from shared.codec import decodeValue, decodeVarint, encodeValue, encodeVarint
+from shared.exceptions import CodecError
+
+# the version of the snapshot format written by dumps()
+SNAPSHOT_VERSION = 1
+
+FLAG_RUNNING = 1
+FLAG_SEEDED = 2
+
+PLAYER_CREATOR = 1
+PLAYER_JOINED = 2
+
+# saved games are stored as compact binary snapshots instead of json
+# a snapshot contains exactly what the users and cards columns used to,
+# so loading a game works the same for both
+# every snapshot starts with its version, followed by the flags, the seed
+# and the rounds of the game, both decks and finally all players
+# card ids are stored as packed arrays of 32 bit little endian integers,
+# all other integers as varints (see shared.codec)
+# a seeded deck consists of its epoch, cursor and returned cards,
+# games saved by older versions contain the complete piles instead
+
+def encodeArray(ids, out):
+  values = array('I', ids)
+  if sys.byteorder == 'big':
+    values.byteswap()
+  encodeVarint(len(values), out)
+  out.extend(values.tostring())
+
+def decodeArray(data, offset):
+  length, offset = decodeVarint(data, offset)
+  end = offset + length * 4
+  if end > len(data):
+    raise IndexError('array exceeds data')
+  values = array('I')
+  values.fromstring(bytes(data[offset:end]))
+  if sys.byteorder == 'big':
+    values.byteswap()
+  return values, end
+
+# users and cards need to look like the json stored by older versions,
+# see Game.pack()
+def dumps(users, cards):
+  out = bytearray()
+  encodeVarint(SNAPSHOT_VERSION, out)
+
+  seeded = 'seed' in cards
+  encodeVarint((FLAG_RUNNING if cards.get('running') else 0) | (FLAG_SEEDED if seeded else 0), out)
+  encodeValue(cards.get('seed'), out)
+  encodeValue(cards['rounds'], out)
+
+  for deck in (cards['black_cards'], cards['white_cards'], ):
+    if seeded:
+      encodeVarint(deck['epoch'], out)
+      encodeVarint(deck['cursor'], out)
+      encodeArray(deck['returned'], out)
+    else:
+      encodeArray(deck, out)
+
+  encodeVarint(len(users), out)
+  for user in users:
+    encodeVarint(user['user'], out)
+    encodeVarint((PLAYER_CREATOR if user['creator'] else 0) | (PLAYER_JOINED if user.get('joined') else 0), out)
+    encodeVarint(user['black_cards'], out)
+    encodeArray(user['white_cards'], out)
+    encodeArray(user.get('chosen_cards', []), out)
+
+  return bytes(out)
+
+# returns the users and cards contained in the snapshot
+# card ids will be returned as arrays instead of lists
+def loads(data):
+  data = bytearray(data)
+
+  try:
+    version, offset = decodeVarint(data, 0)
+    if version != SNAPSHOT_VERSION:
+      raise CodecError('unsupported snapshot version %d'%(version))
+
+    flags, offset = decodeVarint(data, offset)
+    seed, offset = decodeValue(data, offset)
+    rounds, offset = decodeValue(data, offset)
+
+    cards = {'rounds': rounds, 'running': bool(flags & FLAG_RUNNING)}
+    if flags & FLAG_SEEDED:
+      cards['seed'] = seed
+
+    for name in ('black_cards', 'white_cards', ):
+      if flags & FLAG_SEEDED:
+        epoch, offset = decodeVarint(data, offset)
+        cursor, offset = decodeVarint(data, offset)
+        returned, offset = decodeArray(data, offset)
+        cards[name] = {'epoch': epoch, 'cursor': cursor, 'returned': returned}
+      else:
+        cards[name], offset = decodeArray(data, offset)
+
+    count, offset = decodeVarint(data, offset)
+    users = []
+    for i in xrange(count):
+      user, offset = decodeVarint(data, offset)
+      player_flags, offset = decodeVarint(data, offset)
+      black_cards, offset = decodeVarint(data, offset)
+      white_cards, offset = decodeArray(data, offset)
+      chosen_cards, offset = decodeArray(data, offset)
+      users.append({'user': user, 'creator': bool(player_flags & PLAYER_CREATOR), 'joined': bool(player_flags & PLAYER_JOINED), 'black_cards': black_cards, 'white_cards': white_cards, 'chosen_cards': chosen_cards})
+  except IndexError:
+    raise CodecError('truncated snapshot')
+
+  return users, cards
+
+# returns the users and cards of a saved game row,
+# which might still contain json (e.g. within an older journal)
+def unpackRow(data):
+  if data.get('snapshot') is not None:
+    return loads(data['snapshot'])
+  return json.loads(data['users']), json.loads(data['cards'])
+
+# converts the json of a row saved by older versions into a snapshot
+def convertRow(users, cards):
+  return dumps(json.loads(users), json.loads(cards))
@@ -1,3 +1,4 @@
+from twisted.internet import defer
 from twisted.logger import Logger
 
 class User(object):
@@ -8,12 +9,12 @@ class User(object):
     self.id = 0
     self.name = ""
     self.protocol = protocol
-    self.protocol.factory.users.append(self)
+    self.protocol.factory.addUser(self)
 
+  # exists(), login() and register() access the server database
+  # in a separate thread and therefore return deferreds
   def exists(self, name):
-    cursor = self.protocol.factory.serverDatabase.cursor()
-    cursor.execute("SELECT count(*) FROM users WHERE name = ?", (name, ))
-    return bool(cursor.fetchone()[0])
+    return self.protocol.factory.user_repository.exists(name)
 
   def loggedIn(self):
     return self.id > 0
@@ -21,34 +22,39 @@ class User(object):
   def login(self, name, password):
 
     if self.loggedIn():
-      return self.formatted(success=False, message='user %s currently logged in'%username)
+      return defer.succeed(self.formatted(success=False, message='user %s currently logged in'%name))
 
-    cursor = self.protocol.factory.serverDatabase.cursor()
-    cursor.execute("SELECT id FROM users WHERE name = ? AND password = ?", (name, password, ))
-    result = cursor.fetchone()
-    if not result:
+    d = self.protocol.factory.user_repository.login(name, password)
+    d.addCallback(self.loginChecked, name)
+    return d
+
+  def loginChecked(self, id, name):
+    if id is None:
       return self.formatted(success=False, message='wrong login credentials supplied')
 
-    id = int(result[0])
     user = self.protocol.factory.findUser(id)
     if user is not None:
       return self.formatted(success = False, message = 'user currently logged in')
 
+    # the connection may have been lost while checking the credentials
+    if not self.protocol.transport.connected:
+      return self.formatted(success = False, message = 'connection lost')
+
     self.name = name
     self.id = id
+    self.protocol.factory.indexUser(self)
 
     return self.formatted(success=True, message='login successful', user_id = self.id)
 
   def register(self, name, password):
+    d = self.protocol.factory.user_repository.register(name, password)
+    d.addCallback(self.registered)
+    return d
 
-    if self.exists(name):
+  def registered(self, success):
+    if not success:
       return self.formatted(success=False, message='username already in use')
 
-    cursor = self.protocol.factory.serverDatabase.cursor()
-    cursor.execute("INSERT INTO users (name, password) VALUES (?, ?)", (name, password, ))
-
-    self.protocol.factory.serverDatabase.commit()
-
     return self.formatted(success=True, message='registration successful')
 
   def setGame(self, game):
@@ -63,7 +69,7 @@ class User(object):
         self.game.leave(self)
       else:
         self.game.suspend(self)
-    del self.protocol.factory.users[self.protocol.factory.users.index(self)]
+    self.protocol.factory.unlinkUser(self)
 
   # this is quite a dirty way
   # it just formats the keyword arguments into a dict and returns it
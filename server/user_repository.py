@@ -0,0 +1,150 @@
+from collections import OrderedDict
+import time
+
+from twisted.internet import defer
+from twisted.python.failure import Failure
+
+# accounts won't be cached longer than this amount of seconds
+ACCOUNT_CACHE_TTL = 300
+
+# the maximum amount of accounts cached at once
+ACCOUNT_CACHE_SIZE = 1000
+
+# caches account rows by name, dropping the least recently used ones
+# once the cache is full
+# names without an account will be cached as well (as None),
+# so they need to be invalidated as soon as they get registered
+class AccountCache(object):
+
+  def __init__(self, size = ACCOUNT_CACHE_SIZE, ttl = ACCOUNT_CACHE_TTL):
+    # name -> (expiry time, account)
+    self.accounts = OrderedDict()
+    # incremented on every invalidation, see set()
+    self.generation = 0
+    self.hits = 0
+    self.misses = 0
+    self.size = size
+    self.ttl = ttl
+
+  # returns (True, account) if the name is cached, (False, None) otherwise
+  def get(self, name):
+    entry = self.accounts.pop(name, None)
+    if entry is None or entry[0] < time.time():
+      self.misses += 1
+      return False, None
+    # moving it to the end, it's the most recently used one now
+    self.accounts[name] = entry
+    self.hits += 1
+    return True, entry[1]
+
+  # generation needs to be the generation from before the account was read,
+  # so accounts read before being invalidated won't be cached
+  def set(self, name, account, generation):
+    if generation != self.generation:
+      return
+    self.accounts.pop(name, None)
+    self.accounts[name] = (time.time() + self.ttl, account, )
+    while len(self.accounts) > self.size:
+      self.accounts.popitem(last = False)
+
+  def invalidate(self, name):
+    self.accounts.pop(name, None)
+    self.generation += 1
+
+# accesses the users stored in the server database from a thread pool,
+# so the reactor doesn't need to wait for the disk
+# all methods return deferreds
+# registrations arriving while others are being committed will be
+# collected and committed together afterwards, so a burst of new users
+# doesn't need a separate commit (and fsync) for every single one of them
+# accounts are cached, so users reconnecting won't hit the database at all
+class UserRepository(object):
+
+  # pool is the connection pool of the server database
+  # only a single registration commit will be running at a time
+  def __init__(self, pool):
+    self.pool = pool
+    self.cache = AccountCache()
+    # (name, password, deferred) of all registrations waiting to be committed
+    self.registrations = []
+    self.registering = False
+
+  # fires with the (id, password) of the user with the given name,
+  # or None if there is no such user
+  def getAccount(self, name):
+    cached, account = self.cache.get(name)
+    if cached:
+      return defer.succeed(account)
+    d = self.pool.runQuery("SELECT id, password FROM users WHERE name = ?", (name, ))
+    d.addCallback(self.accountRead, name, self.cache.generation)
+    return d
+
+  def accountRead(self, rows, name, generation):
+    account = (int(rows[0][0]), rows[0][1], ) if len(rows) else None
+    self.cache.set(name, account, generation)
+    return account
+
+  # needs to be called whenever an account changes outside of this repository
+  def invalidate(self, name):
+    self.cache.invalidate(name)
+
+  # fires with True if a user with the given name exists
+  def exists(self, name):
+    d = self.getAccount(name)
+    d.addCallback(lambda account: account is not None)
+    return d
+
+  # fires with the id of the user, or None if the credentials are wrong
+  def login(self, name, password):
+    d = self.getAccount(name)
+    d.addCallback(lambda account: account[0] if account is not None and account[1] == password else None)
+    return d
+
+  # fires with False if the name is already in use, True otherwise
+  def register(self, name, password):
+    d = defer.Deferred()
+    self.registrations.append((name, password, d, ))
+    if not self.registering:
+      self.commitRegistrations()
+    return d
+
+  def commitRegistrations(self):
+    registrations = self.registrations
+    self.registrations = []
+    self.registering = True
+    d = self.pool.runInteraction(self.insertUsers, [(name, password, ) for name, password, _ in registrations])
+    d.addBoth(self.registrationsCommitted, registrations)
+
+  def registrationsCommitted(self, result, registrations):
+    self.registering = False
+
+    for i, (name, password, d, ) in enumerate(registrations):
+      # the name is most likely cached as unknown
+      self.invalidate(name)
+      if isinstance(result, Failure):
+        d.errback(result)
+      elif result[i] is None:
+        d.callback(False)
+      else:
+        # the user will most likely login right away
+        self.cache.set(name, (result[i], password, ), self.cache.generation)
+        d.callback(True)
+
+    if len(self.registrations):
+      self.commitRegistrations()
+
+  # runs within a single transaction, checking each name right before
+  # inserting it, so names registered twice within the same batch
+  # will be rejected as well
+  # returns the ids of all inserted users, None for rejected ones
+  @staticmethod
+  def insertUsers(cursor, users):
+    results = []
+    for name, password in users:
+      cursor.execute("SELECT count(*) FROM users WHERE name = ?", (name, ))
+      if cursor.fetchone()[0]:
+        results.append(None)
+      else:
+        cursor.execute("INSERT INTO users (name, password) VALUES (?, ?)", (name, password, ))
+        results.append(cursor.lastrowid)
+    return results
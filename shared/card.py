@@ -8,108 +8,192 @@ CARD_BLACK=1
 
 CARD_PLACEHOLDER_LENGTH=3
 
+# splits a text into the literal segments surrounding its placeholders
+# a text with n placeholders will always result in n+1 segments
+def parsePlaceholders(text):
+  segments = []
+  segment = ''
+  for p in string.Formatter().parse(text):
+    segment += p[0]
+    if p[2] is not None:
+      segments.append(segment)
+      segment = ''
+  segments.append(segment)
+  return tuple(segments)
+
+def validateCardText(id, text, type):
+  # implementing some safety
+  # if the card is white, no wildcards are allowed
+  # also the card may not be empty
+  # if the card is black, wildcards are allowed
+  # there must even be at least one present
+  placeholders = len(parsePlaceholders(text)) - 1
+  if type==CARD_WHITE and placeholders>0:
+    raise CardValidityError({'id':id, 'text': 'White cards may not have any placeholders'})
+  elif type == CARD_WHITE and text.strip(' ')=='':
+    raise CardValidityError({'id': id, 'text': 'White cards need to contain some text'})
+  elif type==CARD_BLACK and placeholders==0:
+    raise CardValidityError({'id': id, 'text': 'Black cards must contain at least one placeholder'})
+  return True
+
+def formatInternalText(text):
+  return re.sub("( ?)__+([.,?!:;\-/ ])", r"\1{}\2",text)
+
+# a single card as stored inside the card database
+# cards are immutable, which allows to share them between all games
+# and card surfaces, use FilledCard to link white cards into a black card
+# texts maps all card texts known so far to themselves, equal texts will be
+# shared between the cards using the same dict instead of being stored twice
+# (intern() can't be used here since card texts are usually unicode)
 class Card(object):
-  def __init__(self, id=-1, text='', type=CARD_WHITE):
-    self.id=id
-    self.__text=text
-    self.type=type
-    self.unlinkAll()
+  __slots__ = ('id', 'placeholders', 'segments', 'text', 'type')
+
+  def __init__(self, id=-1, text='', type=CARD_WHITE, texts=None):
+    if texts is not None:
+      text = texts.setdefault(text, text)
+    segments = parsePlaceholders(text)
+    object.__setattr__(self, 'id', id)
+    object.__setattr__(self, 'placeholders', len(segments) - 1)
+    object.__setattr__(self, 'segments', segments)
+    object.__setattr__(self, 'text', text)
+    object.__setattr__(self, 'type', type)
+
+  def __setattr__(self, name, value):
+    raise AttributeError("cards are immutable")
+
+  def __delattr__(self, name):
+    raise AttributeError("cards are immutable")
+
+  def __reduce__(self):
+    return (Card, (self.id, self.text, self.type, ))
+
+  # immutable, so copies can just share the same card
+  def __copy__(self):
+    return self
+
+  def __deepcopy__(self, memo):
+    return self
 
   def isValid(self, text=None):
-    # implementing some safety
-    # if the card is white, no wildcards are allowed
-    # also the card may not be empty
-    # if the card is black, wildcards are allowed
-    # there must even be at least one present
-    
     # if text is None, use the current internal text
     if text is None:
-      text = self.getInternalText()
-
-    format_iterator = string.Formatter().parse(text)
-    placeholders = [p[2] for p in format_iterator if p[2] is not None]
-    if self.type==CARD_WHITE and len(placeholders)>0:
-      raise CardValidityError({'id':self.id, 'text': 'White cards may not have any placeholders'})
-    elif self.type == CARD_WHITE and text.strip(' ')=='':
-      raise CardValidityError({'id': self.id, 'text': 'White cards need to contain some text'})
-    elif self.type==CARD_BLACK and len(placeholders)==0:
-      raise CardValidityError({'id': self.id, 'text': 'Black cards must contain at least one placeholder'})      
-    return True
-
-  # sets the internal text (usually just needed internally)
-  def setInternalText(self, text):
-    # will run through the isValid check
-    if self.isValid(text):
-      self.__text = text
-      self.unlinkAll()
+      text = self.text
+    return validateCardText(self.id, text, self.type)
 
   def getInternalText(self):
-    return self.__text
+    return self.text
 
   # retrieves the properly formatted card text
   def getCardText(self):
-    return self.formatCardText(self.getInternalText())
+    return ('_' * CARD_PLACEHOLDER_LENGTH).join(self.segments)
 
-  # parses the text and will set it internally too
-  def setCardText(self, text):
-    format_iterator = string.Formatter().parse(text)
-    placeholders = [p[2] for p in format_iterator if p[2] is not None]
-    # we don't accept already well formatted placeholders inside the actual card text
-    if len(placeholders)>0:
-      raise CardValidityError({'id':self.id, 'text': 'invalid text found inside the card text: {%s}'%(placeholders[0])})
-    internal_text = self.formatInternalText(text)
-    self.setInternalText(internal_text)
+# a black card with white cards linked into its placeholders
+# the black card itself won't be touched by linking cards
+class FilledCard(object):
+  __slots__ = ('card', 'filled')
 
-  def formatInternalText(self, text):
-    return re.sub("( ?)__+([.,?!:;\-/ ])", r"\1{}\2",text)
-
-  def formatCardText(self, text):
-    return text.format(*self.__placeholder_texts)
-    
-  def link(self, card, index = -1):
-    if self.type != CARD_BLACK:
+  def __init__(self, card):
+    if card.type != CARD_BLACK:
       raise CardLinkError("only black cards may link cards")
 
+    self.card = card
+    self.unlinkAll()
+
+  def getInternalText(self):
+    return self.card.text
+
+  def getCardText(self):
+    texts = []
+    for i in range(self.card.placeholders):
+      texts.append(self.card.segments[i])
+      if self.filled[i] is None:
+        texts.append('_' * CARD_PLACEHOLDER_LENGTH)
+      else:
+        texts.append(self.filled[i].getCardText())
+    texts.append(self.card.segments[-1])
+
+    return ''.join(texts)
+
+  def link(self, card, index = -1):
     if card.type != CARD_WHITE:
       raise CardLinkError("only white cards may be linked to black cards")
 
     if index == -1:
       try:
-        index = self.__links.index(None)
+        index = self.filled.index(None)
       except ValueError:
         raise CardLinkError("placeholders exceeded")
 
     try:
-      self.__links[index] = card
-    except ValueError:
+      self.filled[index] = card
+    except IndexError:
       raise CardLinkError("index out of range")
 
   def unlink(self, card):
 
     try:
-      self.__links[self.__links.index(card)] = None
+      self.filled[self.filled.index(card)] = None
     except ValueError:
       raise CardLinkError("card not linked")
 
   def unlinkAll(self):
-    self.__links = [None] * self.placeholders
+    self.filled = [None] * self.card.placeholders
 
   @property
-  def placeholders(self):
-    format_iterator = string.Formatter().parse(self.__text)
-    return len([p[2] for p in format_iterator if p[2] is not None])
+  def id(self):
+    return self.card.id
 
   @property
-  def __placeholder_texts(self):
-    texts = []
-    for l in self.__links:
-      if l is None:
-        texts.append('_' * CARD_PLACEHOLDER_LENGTH)
-      else:
-        texts.append(l.getCardText())
+  def type(self):
+    return self.card.type
 
-    return texts
+  @property
+  def placeholders(self):
+    return self.card.placeholders
 
   @property
   def links(self):
-    return [l for l in self.__links if l is not None]
+    return [l for l in self.filled if l is not None]
+
+# a card which can be modified, as needed when editing card databases
+class EditableCard(object):
+  def __init__(self, id=-1, text='', type=CARD_WHITE):
+    self.id=id
+    self.__text=text
+    self.type=type
+
+  def isValid(self, text=None):
+    # if text is None, use the current internal text
+    if text is None:
+      text = self.getInternalText()
+    return validateCardText(self.id, text, self.type)
+
+  # sets the internal text (usually just needed internally)
+  def setInternalText(self, text):
+    # will run through the isValid check
+    if self.isValid(text):
+      self.__text = text
+
+  def getInternalText(self):
+    return self.__text
+
+  # retrieves the properly formatted card text
+  def getCardText(self):
+    return ('_' * CARD_PLACEHOLDER_LENGTH).join(parsePlaceholders(self.__text))
+
+  # parses the text and will set it internally too
+  def setCardText(self, text):
+    format_iterator = string.Formatter().parse(text)
+    placeholders = [p[2] for p in format_iterator if p[2] is not None]
+    # we don't accept already well formatted placeholders inside the actual card text
+    if len(placeholders)>0:
+      raise CardValidityError({'id':self.id, 'text': 'invalid text found inside the card text: {%s}'%(placeholders[0])})
+    internal_text = self.formatInternalText(text)
+    self.setInternalText(internal_text)
+
+  def formatInternalText(self, text):
+    return formatInternalText(text)
+
+  @property
+  def placeholders(self):
+    return len(parsePlaceholders(self.__text)) - 1
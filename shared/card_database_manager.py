@@ -1,24 +1,74 @@
+from collections import deque
 import hashlib
+import json
 import os
 import os.path
+import re
+import shutil
 import sqlite3
+import tempfile
+import zlib
 
 from .card import *
 from .path import getScriptDirectory
 
 MAX_PLAYERS_PER_GAME = 10
 
+# compression methods supported when transferring card databases
+COMPRESSION_METHODS = ('zlib', )
+
+# card databases are transferred in chunks of this size (before compression)
+TRANSFER_CHUNK_SIZE = 65536
+
+# incomplete downloads will be kept in files with this suffix
+PARTIAL_SUFFIX = '.part'
+
+# cards fetched by lazy clients will be cached in a database with this suffix
+LAZY_SUFFIX = '.lazy'
+
+# the hash of a database will be cached in a file with this suffix
+HASH_SUFFIX = '.hash'
+
+# the maximum amount of cards which can be requested at once
+MAX_CARDS_PER_QUERY = 100
+
+# computes a digest over the contents of all given cards,
+# no matter how the database containing them is laid out on disk
+# cards need to be (id, text, type) tuples, sorted by id
+def digestCards(cards):
+  digest = hashlib.sha256()
+  for card in cards:
+    digest.update('%d:%d:'%(card[0], card[2]))
+    digest.update(card[1].encode('utf-8'))
+    digest.update('\0')
+  return digest.hexdigest()
+
+# moves source onto target, replacing target if it exists
+def replaceFile(source, target):
+  # windows refuses to rename onto existing files
+  if os.name == 'nt' and os.path.exists(target):
+    os.remove(target)
+  os.rename(source, target)
+
 class CardDatabaseManager(object):
 
-  cards = []
-  data = None
+  black_card_count = 0
+  black_cards = ()
+  cards = {}
   database = None
   hash = ''
+  # lazy databases only contain the cards fetched from the server so far
+  lazy = False
   loaded = False
+  path = None
   size = 0
+  white_card_count = 0
+  white_cards = ()
 
   def __init__(self):
-    pass
+    # the card texts of this catalog, see Card
+    # they will be freed together with the catalog
+    self.texts = {}
 
   # if hash is None, the path will be loaded without any suffix
   # if a hash is given, the manager will try to load a database
@@ -28,36 +78,210 @@ class CardDatabaseManager(object):
     path = self.makePath(path, hash)
 
     if not os.path.exists(path):
+      self.loaded = False
       return
 
-    self.data = open(path, 'rb').read()
-
-    self.size = len(self.data)
-
+    # the database itself won't be kept in memory,
+    # it will be read from disk again whenever it needs to be sent
     if hash is not None:
       self.hash = hash
+      self.size = os.path.getsize(path)
     else:
-      self.hash = hashlib.sha512(self.data).hexdigest()
+      self.hash, self.size = self.getFileHash(path)
 
+    self.path = path
     self.database = sqlite3.connect(path)
 
+    self.lazy = False
     self.loaded = True
 
-  def loadData(self, data, host, hash):
+  # opens the lazy cache for the database with the given hash,
+  # which will be created if it doesn't exist yet
+  # cards missing from it need to be fetched from the server
+  # and added using addCards()
+  def loadLazy(self, host, hash):
 
-    path = self.makePath(host, hash)
+    path = self.makePath(host, hash) + LAZY_SUFFIX
 
-    db = open(path, 'wb')
-    db.write(data)
+    self.database = sqlite3.connect(path)
+    self.database.execute("CREATE TABLE IF NOT EXISTS 'cards' ('id' INTEGER PRIMARY KEY NOT NULL, 'text' VARCHAR(1000), 'type' TINYINT(1))")
+    self.database.commit()
 
-    self.data = data
     self.hash = hash
-    self.size = len(data)
-
-    self.database = sqlite3.connect(path)
+    self.path = path
+    self.size = 0
 
+    self.lazy = True
     self.loaded = True
 
+  # prepares the download of the database with the given hash
+  # see CardDatabaseDownload for all arguments
+  # the returned download needs to be finished before calling loadPath()
+  def download(self, host, hash, compression = None, offset = 0, chunks = None, resumable = False):
+    return CardDatabaseDownload(self.makePath(host, hash), hash, compression, offset, chunks, resumable)
+
+  # returns the amount of bytes already downloaded and verified
+  # of the database with the given hash
+  def getPartialSize(self, host, hash):
+    path = self.makePath(host, hash) + PARTIAL_SUFFIX
+    if not os.path.exists(path):
+      return 0
+    size = os.path.getsize(path)
+    return size - size % TRANSFER_CHUNK_SIZE
+
+  # returns the hashes of all databases cached for the given host
+  def getCachedHashes(self, host):
+    path = self.makePath(host, '')
+    directory = os.path.dirname(path)
+    expression = re.compile(re.escape(os.path.basename(path)) + '([0-9a-f]{128})$')
+    hashes = []
+    for name in os.listdir(directory):
+      match = expression.match(name)
+      if match is not None:
+        hashes.append(match.group(1))
+    return hashes
+
+  # keeps a copy of the loaded database as name.<hash> within the database
+  # directory, so deltas against this version can be built later on
+  def archive(self, name):
+    path = self.makePath(name, self.hash)
+    if os.path.exists(path):
+      return
+    fd, temp_path = tempfile.mkstemp(prefix = os.path.basename(path) + '.', suffix = '.tmp', dir = os.path.dirname(path))
+    with os.fdopen(fd, 'wb') as target, open(self.path, 'rb') as source:
+      shutil.copyfileobj(source, target)
+    replaceFile(temp_path, path)
+
+  # returns the delta needed to turn the database archived under name
+  # with the given hash into the loaded one, or None if that version
+  # isn't archived
+  # the delta contains all added or changed cards as [id, text, type],
+  # the ids of all removed cards and the digest of the resulting cards
+  def getDelta(self, name, hash):
+    path = self.makePath(name, hash)
+    if not os.path.exists(path):
+      return None
+
+    base = dict((c[0], c) for c in self.readCards(path))
+
+    cards = [[c.id, c.text, c.type] for id, c in sorted(self.cards.iteritems()) if base.get(id) != (c.id, c.text, c.type)]
+    removed = [id for id in sorted(base) if id not in self.cards]
+
+    return {
+            'cards': cards,
+            'digest': self.getDigest(),
+            'removed': removed
+           }
+
+  # applies a delta created by getDelta() to the database cached for host
+  # with hash base, and caches the result under the new hash
+  # returns False if the base isn't cached or the result doesn't match
+  # the digest, the new database won't be cached in that case
+  def applyDelta(self, host, base, hash, delta):
+    base_path = self.makePath(host, base)
+    if not os.path.exists(base_path):
+      return False
+
+    path = self.makePath(host, hash)
+    fd, temp_path = tempfile.mkstemp(prefix = os.path.basename(path) + '.', suffix = '.tmp', dir = os.path.dirname(path))
+    with os.fdopen(fd, 'wb') as target, open(base_path, 'rb') as source:
+      shutil.copyfileobj(source, target)
+
+    database = sqlite3.connect(temp_path)
+    database.executemany('INSERT OR REPLACE INTO cards (id, text, type) VALUES (?, ?, ?)', delta['cards'])
+    database.executemany('DELETE FROM cards WHERE id = ?', [(id, ) for id in delta['removed']])
+    database.commit()
+    database.close()
+
+    # the file itself will differ from the one on the server,
+    # but the cards within have to be the same
+    if digestCards(self.readCards(temp_path)) != delta['digest']:
+      os.remove(temp_path)
+      return False
+
+    replaceFile(temp_path, path)
+    return True
+
+  # reads all cards of the database found at path as (id, text, type) tuples
+  @staticmethod
+  def readCards(path):
+    database = sqlite3.connect(path)
+    try:
+      return database.execute('SELECT id, text, type FROM cards ORDER BY id').fetchall()
+    finally:
+      database.close()
+
+  # returns the digest of all loaded cards
+  def getDigest(self):
+    return digestCards((id, c.text, c.type) for id, c in sorted(self.cards.iteritems()))
+
+  # returns the hash and size of the given file
+  # the hash will be cached next to the file and only computed again
+  # once the file changed, identified by its size, mtime and inode
+  @staticmethod
+  def getFileHash(path):
+    stat = os.stat(path)
+    key = [os.path.abspath(path), stat.st_size, stat.st_mtime, stat.st_ino]
+    cache_path = path + HASH_SUFFIX
+
+    try:
+      with open(cache_path, 'rb') as file:
+        cache = json.load(file)
+      if cache['key'] == key:
+        return str(cache['hash']), stat.st_size
+    except (IOError, ValueError, KeyError, TypeError):
+      pass
+
+    hash, size = CardDatabaseManager.hashFile(path)
+
+    # the file may have changed while hashing it
+    if size == stat.st_size:
+      try:
+        with open(cache_path, 'wb') as file:
+          json.dump({'key': key, 'hash': hash}, file)
+      except IOError:
+        # the cache is optional, e.g. if the directory is read-only
+        pass
+
+    return hash, size
+
+  # returns the sha512 hash and size of the given file
+  # the file will be read in chunks, so it never needs to fit into memory
+  @staticmethod
+  def hashFile(path, chunk_size = 65536):
+    hash = hashlib.sha512()
+    size = 0
+
+    with open(path, 'rb') as file:
+      for chunk in iter(lambda: file.read(chunk_size), ''):
+        hash.update(chunk)
+        size += len(chunk)
+
+    return hash.hexdigest(), size
+
+  # splits the given file into chunks for transferring it
+  # if compression is given, every chunk will be compressed on its own,
+  # so the transfer can be resumed at any chunk
+  # returns the compressed data (None if uncompressed) and a list of
+  # (transferred length, crc32 of the uncompressed data) for every chunk
+  @staticmethod
+  def chunkFile(path, compression = None, chunk_size = TRANSFER_CHUNK_SIZE):
+    chunks = []
+    compressed = []
+
+    with open(path, 'rb') as file:
+      for chunk in iter(lambda: file.read(chunk_size), ''):
+        crc = zlib.crc32(chunk) & 0xffffffff
+        if compression == 'zlib':
+          chunk = zlib.compress(chunk, 9)
+          compressed.append(chunk)
+        chunks.append((len(chunk), crc, ))
+
+    if compression is None:
+      return None, chunks
+
+    return ''.join(compressed), chunks
+
   def makePath(self, path, hash=None):
 
     # making it absolute
@@ -74,31 +298,179 @@ class CardDatabaseManager(object):
 
     return path
 
+  # builds the card catalog once
+  # cards maps card ids to cards, black_cards and white_cards
+  # contain the ids of all cards of the respective type
   def loadCards(self):
 
     if not self.loaded:
       return
 
-    self.cards = []
+    cards = {}
+    black_cards = []
+    white_cards = []
+    self.texts = {}
 
     cursor = self.database.cursor()
-    cursor.execute('SELECT id, text, type FROM cards')
+    cursor.execute('SELECT id, text, type FROM cards ORDER BY id')
 
     for card in cursor.fetchall():
-      self.cards.append(Card(card[0], card[1], card[2]))
+      cards[card[0]] = Card(card[0], card[1], card[2], self.texts)
+      if card[2] == CARD_BLACK:
+        black_cards.append(card[0])
+      else:
+        white_cards.append(card[0])
+
+    self.cards = cards
+    self.black_cards = tuple(black_cards)
+    self.white_cards = tuple(white_cards)
+    self.black_card_count = len(self.black_cards)
+    self.white_card_count = len(self.white_cards)
 
   def getBlackCards(self):
-    return [c for c in self.cards if c.type == CARD_BLACK]
+    return [self.cards[id] for id in self.black_cards]
 
   def getWhiteCards(self):
-    return [c for c in self.cards if c.type == CARD_WHITE]
+    return [self.cards[id] for id in self.white_cards]
 
   def getCard(self, id):
-    card = [c for c in self.cards if c.id == id]
-    if len(card) != 1:
-      return None
-    return card[0]
+    return self.cards.get(id)
+
+  # resolves multiple card ids at once
+  # unknown ids will be resolved to None
+  def getCards(self, ids):
+    return [self.cards.get(id) for id in ids]
+
+  # returns all ids not found in the catalog, without duplicates
+  def getMissingCards(self, ids):
+    return list(set(id for id in ids if id not in self.cards))
+
+  # adds cards fetched from the server to the catalog
+  # only lazy caches will keep them, complete databases need to keep
+  # matching their hash
+  # cards need to be (id, text, type) tuples
+  def addCards(self, cards):
+    for card in cards:
+      self.cards[card[0]] = Card(card[0], card[1], card[2], self.texts)
+    if not self.lazy:
+      return
+    self.database.executemany('INSERT OR REPLACE INTO cards (id, text, type) VALUES (?, ?, ?)', cards)
+    self.database.commit()
 
   @property
   def max_players_per_game(self):
-    return min(MAX_PLAYERS_PER_GAME, len(self.getWhiteCards())/10, len(self.getBlackCards()))
+    return min(MAX_PLAYERS_PER_GAME, self.white_card_count/10, self.black_card_count)
+
+# a card database currently being downloaded
+# all data will be written to a partial file next to the final path
+# and only moved there once it matches the expected hash,
+# so the final path never contains an incomplete or corrupted database
+# if chunks are given, the data consists of chunks as created by
+# CardDatabaseManager.chunkFile(), every chunk will be verified on its own
+# and the partial file will only contain verified chunks,
+# so an aborted download can be resumed later on
+# offset is the position within the database the data starts at,
+# the partial file needs to contain at least that many bytes already
+# resumable keeps unchunked data (e.g. downloaded over http) in the partial
+# file as well when aborting, it will only be discarded if the finished
+# database doesn't match its hash
+class CardDatabaseDownload(object):
+
+  def __init__(self, path, hash, compression = None, offset = 0, chunks = None, resumable = False):
+    if compression not in (None, 'zlib'):
+      raise ValueError('unknown compression method %s'%(compression))
+    self.buffer = []
+    self.buffered = 0
+    self.chunks = deque(chunks) if chunks is not None else None
+    self.compression = compression
+    self.corrupted = False
+    self.digest = hashlib.sha512()
+    self.hash = hash
+    self.path = path
+    self.resumable = resumable or chunks is not None
+    self.size = 0
+    self.temp_path = path + PARTIAL_SUFFIX
+
+    if offset > 0 and os.path.exists(self.temp_path) and os.path.getsize(self.temp_path) >= offset:
+      self.file = open(self.temp_path, 'r+b')
+      self.file.truncate(offset)
+      for chunk in iter(lambda: self.file.read(min(65536, offset - self.size)), ''):
+        self.digest.update(chunk)
+        self.size += len(chunk)
+      self.file.seek(offset)
+    else:
+      self.file = open(self.temp_path, 'wb')
+      # the server resumes a download we don't have anymore
+      self.corrupted = offset > 0
+
+  def write(self, data):
+    if self.corrupted:
+      return
+
+    if self.chunks is None:
+      return self.writeChunk(data)
+
+    self.buffer.append(data)
+    self.buffered += len(data)
+
+    while len(self.chunks) and self.buffered >= self.chunks[0][0]:
+      length, crc = self.chunks.popleft()
+      data = ''.join(self.buffer)
+      chunk = data[:length]
+      self.buffer = [data[length:]]
+      self.buffered -= length
+
+      if self.compression == 'zlib':
+        # a chunk never inflates beyond the chunk size
+        try:
+          decompressor = zlib.decompressobj()
+          chunk = decompressor.decompress(chunk, TRANSFER_CHUNK_SIZE)
+          if len(decompressor.unconsumed_tail):
+            raise zlib.error('chunk exceeds chunk size')
+        except zlib.error:
+          self.corrupted = True
+          return
+
+      if zlib.crc32(chunk) & 0xffffffff != crc:
+        self.corrupted = True
+        return
+
+      self.writeChunk(chunk)
+
+  def writeChunk(self, data):
+    self.file.write(data)
+    self.digest.update(data)
+    self.size += len(data)
+    if self.resumable:
+      # the data needs to end up on disk, to be able to resume
+      self.file.flush()
+
+  # returns True if the downloaded database matches its hash
+  # and was moved into place
+  # otherwise it will be discarded, except for all verified chunks
+  def finish(self):
+    self.file.close()
+
+    if self.chunks is not None and (len(self.chunks) or self.buffered):
+      self.corrupted = True
+
+    if self.corrupted:
+      if not self.resumable:
+        os.remove(self.temp_path)
+      return False
+
+    if self.digest.hexdigest() != self.hash:
+      os.remove(self.temp_path)
+      return False
+
+    replaceFile(self.temp_path, self.path)
+    return True
+
+  # stops the download, the data received so far will be kept
+  # to resume it later on if the download is resumable
+  def abort(self):
+    if self.file.closed:
+      return
+    self.file.close()
+    if not self.resumable:
+      os.remove(self.temp_path)
@@ -0,0 +1,366 @@
+import json
+import struct
+
+from .exceptions import CodecError
+from .messages import *
+
+# codecs define how messages are represented on the wire
+# json is the original format, every message being a single json line
+# binary frames every message with a varint length prefix, followed by
+# the message code and all fields in the order given by the message schema
+# the codec is negotiated during client authentification,
+# json will always be used until then
+
+# the fields each message may contain, in the order they are encoded with
+# fields may only be appended to these, never removed or reordered,
+# otherwise older binary peers will decode them wrong
+# fields which aren't listed here will still be transmitted, but by name
+SCHEMAS = {
+  MSG_SERVER_AUTHENTIFICATION: ('major', 'minor', 'revision'),
+  MSG_USER_AUTHENTIFICATION: ('username', 'password'),
+  MSG_USER_REGISTRATION: ('success', 'message'),
+  MSG_USER_LOGIN: ('success', 'message', 'user_id'),
+  MSG_CLIENT_AUTHENTIFICATION: ('major', 'minor', 'revision', 'codecs'),
+  MSG_CLIENT_REFUSED: ('reason', ),
+  MSG_CLIENT_ACCEPTED: ('codec', ),
+  MSG_DATABASE_QUERY: ('hash', 'http', 'url'),
+  MSG_DATABASE_PULL: ('compression', 'known', 'offset'),
+  MSG_DATABASE_PUSH: ('size', 'compression', 'offset', 'chunks', 'more'),
+  MSG_DATABASE_KNOWN: (),
+  MSG_SYNC_FINISHED: (),
+  MSG_CREATE_GAME: ('success', 'message', 'game_id', 'name', 'creator', 'rounds', 'protected', 'game_name', 'game_password', 'users'),
+  MSG_JOIN_GAME: ('success', 'message', 'game_id', 'user_id', 'users', 'game_password'),
+  MSG_START_GAME: ('success', 'message'),
+  MSG_STARTED_GAME: ('user_id', 'points'),
+  MSG_DRAW_CARDS: ('cards', ),
+  MSG_CZAR_CHANGE: ('user_id', 'card'),
+  MSG_CHOICES: ('choices', ),
+  MSG_LOGGED_IN: ('user_id', 'user_name'),
+  MSG_CURRENT_GAMES: ('games', ),
+  MSG_CURRENT_USERS: ('users', ),
+  MSG_LOGGED_OFF: ('user_id', ),
+  MSG_LEAVE_GAME: ('success', 'message', 'game_id', 'user_id'),
+  MSG_CZAR_DECISION: ('success', 'message', 'winner', 'end', 'rounds', 'cards'),
+  MSG_DELETE_GAME: ('success', 'message', 'game_id'),
+  MSG_CHOOSE_CARDS: ('success', 'message', 'user_id', 'cards'),
+  MSG_SUSPEND_GAME: ('user_id', 'game_id'),
+  MSG_DATABASE_DELTA: ('base', 'cards', 'removed', 'digest', 'more'),
+  MSG_CARDS_QUERY: ('ids', ),
+  MSG_CARDS: ('cards', 'more'),
+  MSG_RELOAD_DATABASE: ('success', 'message'),
+}
+
+# dict keys which will be transmitted as index instead of the whole string
+# just like the schemas, this list may only be appended to
+KEYS = ('creator', 'id', 'name', 'protected', 'rounds', 'users')
+
+KEY_INDEXES = dict((k, i) for i, k in enumerate(KEYS))
+
+TAG_NONE = 0
+TAG_FALSE = 1
+TAG_TRUE = 2
+TAG_INT = 3
+TAG_NEGATIVE_INT = 4
+TAG_STRING = 5
+TAG_LIST = 6
+TAG_DICT = 7
+TAG_FLOAT = 8
+# large integers like game ids (128 bit uuids) are stored as big endian bytes
+TAG_BIG_INT = 9
+# raw bytes, only used by the server itself (see server.journal),
+# json can't represent them
+TAG_BYTES = 10
+# integers from 0 to 127 are stored within the tag itself
+TAG_SMALL_INT = 0x80
+
+# integers from here on will be stored using TAG_BIG_INT instead of a varint
+BIG_INT = 1 << 63
+
+def encodeVarint(value, out):
+  while value > 0x7f:
+    out.append((value & 0x7f) | 0x80)
+    value >>= 7
+  out.append(value)
+
+# returns the decoded value and the offset right behind it
+# raises IndexError if data ends before the varint does
+def decodeVarint(data, offset):
+  value = data[offset]
+  if value < 0x80:
+    return value, offset + 1
+  value = 0
+  shift = 0
+  while True:
+    byte = data[offset]
+    offset += 1
+    value |= (byte & 0x7f) << shift
+    if byte < 0x80:
+      return value, offset
+    shift += 7
+
+def encodeString(value, out):
+  if isinstance(value, unicode):
+    value = value.encode('utf-8')
+  encodeVarint(len(value), out)
+  out.extend(value)
+
+def decodeString(data, offset):
+  length, offset = decodeVarint(data, offset)
+  if offset + length > len(data):
+    raise IndexError('string exceeds data')
+  return data[offset:offset + length].decode('utf-8'), offset + length
+
+def encodeValue(value, out):
+  if value is None:
+    out.append(TAG_NONE)
+  elif value is True:
+    out.append(TAG_TRUE)
+  elif value is False:
+    out.append(TAG_FALSE)
+  elif isinstance(value, (int, long)):
+    if 0 <= value < 0x80:
+      out.append(TAG_SMALL_INT | value)
+    elif value >= BIG_INT:
+      value = '%x'%(value)
+      value = ('0' * (len(value) & 1) + value).decode('hex')
+      out.append(TAG_BIG_INT)
+      out.append(len(value))
+      out.extend(value)
+    elif value >= 0:
+      out.append(TAG_INT)
+      encodeVarint(value, out)
+    else:
+      out.append(TAG_NEGATIVE_INT)
+      encodeVarint(-value - 1, out)
+  elif isinstance(value, (buffer, bytearray)):
+    out.append(TAG_BYTES)
+    encodeVarint(len(value), out)
+    out.extend(value)
+  elif isinstance(value, basestring):
+    out.append(TAG_STRING)
+    encodeString(value, out)
+  elif isinstance(value, (list, tuple)):
+    out.append(TAG_LIST)
+    encodeVarint(len(value), out)
+    for v in value:
+      encodeValue(v, out)
+  elif isinstance(value, dict):
+    out.append(TAG_DICT)
+    encodeDict(value, out)
+  elif isinstance(value, float):
+    out.append(TAG_FLOAT)
+    out.extend(struct.pack('>d', value))
+  else:
+    raise TypeError('%r is not encodable'%(value, ))
+
+def encodeDict(value, out):
+  encodeVarint(len(value), out)
+  for k, v in value.iteritems():
+    index = KEY_INDEXES.get(k)
+    if index is None:
+      out.append(0)
+      encodeString(k, out)
+    else:
+      encodeVarint(index + 1, out)
+    encodeValue(v, out)
+
+def decodeValue(data, offset):
+  tag = data[offset]
+  offset += 1
+
+  if tag & TAG_SMALL_INT:
+    return tag & 0x7f, offset
+  elif tag == TAG_NONE:
+    return None, offset
+  elif tag == TAG_FALSE:
+    return False, offset
+  elif tag == TAG_TRUE:
+    return True, offset
+  elif tag == TAG_INT:
+    return decodeVarint(data, offset)
+  elif tag == TAG_NEGATIVE_INT:
+    value, offset = decodeVarint(data, offset)
+    return -value - 1, offset
+  elif tag == TAG_STRING:
+    return decodeString(data, offset)
+  elif tag == TAG_LIST:
+    length, offset = decodeVarint(data, offset)
+    value = []
+    for i in xrange(length):
+      # lists mostly contain card or user ids, so take a shortcut for those
+      tag = data[offset]
+      if tag & TAG_SMALL_INT:
+        value.append(tag & 0x7f)
+        offset += 1
+      elif tag == TAG_INT:
+        v, offset = decodeVarint(data, offset + 1)
+        value.append(v)
+      else:
+        v, offset = decodeValue(data, offset)
+        value.append(v)
+    return value, offset
+  elif tag == TAG_DICT:
+    return decodeDict(data, offset)
+  elif tag == TAG_BIG_INT:
+    length = data[offset]
+    offset += 1
+    if offset + length > len(data):
+      raise IndexError('integer exceeds data')
+    return long(bytes(data[offset:offset + length]).encode('hex'), 16), offset + length
+  elif tag == TAG_FLOAT:
+    if offset + 8 > len(data):
+      raise IndexError('float exceeds data')
+    return struct.unpack('>d', bytes(data[offset:offset + 8]))[0], offset + 8
+  elif tag == TAG_BYTES:
+    length, offset = decodeVarint(data, offset)
+    if offset + length > len(data):
+      raise IndexError('bytes exceed data')
+    return bytes(data[offset:offset + length]), offset + length
+
+  raise CodecError('unknown value tag %d'%(tag))
+
+def decodeDict(data, offset):
+  length, offset = decodeVarint(data, offset)
+  value = {}
+  for i in xrange(length):
+    index, offset = decodeVarint(data, offset)
+    if index == 0:
+      k, offset = decodeString(data, offset)
+    elif index <= len(KEYS):
+      k = KEYS[index - 1]
+    else:
+      raise CodecError('unknown key index %d'%(index))
+    value[k], offset = decodeValue(data, offset)
+  return value, offset
+
+class JSONCodec(object):
+  name = 'json'
+  # json messages are delimited by line breaks,
+  # they don't need to be framed by the codec
+  framed = False
+
+  def __init__(self, delimiter = '\r\n'):
+    self.delimiter = delimiter
+
+  def encode(self, code, data):
+    data = data.copy()
+    data['code'] = int(code)
+    return json.dumps(data) + self.delimiter
+
+  def decode(self, line):
+    data = json.loads(line)
+    code = int(data['code'])
+    del(data['code'])
+    return code, data
+
+class BinaryCodec(object):
+  name = 'binary'
+  framed = True
+
+  def __init__(self):
+    self.fields = dict((code, frozenset(schema)) for code, schema in SCHEMAS.iteritems())
+
+  def encode(self, code, data):
+    schema = SCHEMAS.get(code, ())
+    payload = bytearray()
+    encodeVarint(code, payload)
+
+    # every field of the schema gets a bit, telling whether it is present
+    # the bit behind those is set if any fields not known by the schema follow
+    present = 0
+    values = []
+    for i, field in enumerate(schema):
+      if field in data:
+        present |= 1 << i
+        values.append(data[field])
+
+    extra = None
+    if len(values) < len(data):
+      fields = self.fields.get(code, frozenset())
+      extra = dict((k, v) for k, v in data.iteritems() if k not in fields)
+      present |= 1 << len(schema)
+
+    encodeVarint(present, payload)
+
+    for value in values:
+      encodeValue(value, payload)
+
+    if extra is not None:
+      encodeDict(extra, payload)
+
+    frame = bytearray()
+    encodeVarint(len(payload), frame)
+    frame.extend(payload)
+    return bytes(frame)
+
+  # reads the frame starting at offset
+  # data needs to be a bytearray
+  # returns the message code, the message and the offset behind the frame,
+  # or None if the frame wasn't received completely yet
+  def readFrame(self, data, offset = 0, max_length = None):
+    try:
+      length, start = decodeVarint(data, offset)
+    except IndexError:
+      if len(data) - offset > 10:
+        raise CodecError('invalid frame length')
+      return None
+
+    if max_length is not None and length > max_length:
+      raise CodecError('frame length %d exceeds maximum of %d'%(length, max_length))
+
+    end = start + length
+    if end > len(data):
+      return None
+
+    try:
+      code, message = self.decode(data, start, end)
+    except IndexError:
+      raise CodecError('truncated message')
+
+    return code, message, end
+
+  # decodes the frame payload found in data between start and end
+  def decode(self, data, start = 0, end = None):
+    if end is None:
+      end = len(data)
+    code, offset = decodeVarint(data, start)
+    present, offset = decodeVarint(data, offset)
+    schema = SCHEMAS.get(code, ())
+
+    message = {}
+
+    for i, field in enumerate(schema):
+      if present & (1 << i):
+        message[field], offset = decodeValue(data, offset)
+
+    if present >> len(schema):
+      extra, offset = decodeDict(data, offset)
+      message.update(extra)
+
+    if offset != end:
+      raise CodecError('message %d ends at %d, but frame ends at %d'%(code, offset, end))
+
+    return code, message
+
+JSON = JSONCodec()
+BINARY = BinaryCodec()
+
+# all codecs, in order of preference
+CODECS = (BINARY, JSON, )
+
+def getCodec(name):
+  for codec in CODECS:
+    if codec.name == name:
+      return codec
+  return None
+
+def getCodecNames():
+  return [c.name for c in CODECS]
+
+# selects the preferred codec out of the given names
+# falls back to json if none of them is known
+def selectCodec(names):
+  for codec in CODECS:
+    if codec.name in names:
+      return codec
+  return JSON
@@ -16,7 +16,10 @@ class Configurator(object):
 
   options = {
     'client': {
-      'language': Translator.getDefaultLanguage()
+      'language': Translator.getDefaultLanguage(),
+      # only fetch cards from the server when they are needed,
+      # instead of downloading the whole card database
+      'lazy_card_database': False
     },
     'editor': {
       'language': Translator.getDefaultLanguage()
@@ -3,3 +3,6 @@ class CardValidityError(Exception):
 
 class CardLinkError(Exception):
   pass
+
+class CodecError(Exception):
+  pass
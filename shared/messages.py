@@ -26,6 +26,10 @@ MSG_CZAR_DECISION = 25
 MSG_DELETE_GAME = 26
 MSG_CHOOSE_CARDS = 27
 MSG_SUSPEND_GAME = 28
+MSG_DATABASE_DELTA = 29
+MSG_CARDS_QUERY = 30
+MSG_CARDS = 31
+MSG_RELOAD_DATABASE = 32
 
 MODE_NONE = 0
 MODE_CLIENT_AUTHENTIFICATION = 1
@@ -1,37 +1,223 @@
-import json
+from twisted.internet import reactor
 from twisted.logger import Logger
-from twisted.protocols.basic import LineReceiver
+from twisted.protocols.basic import FileSender, LineReceiver
+from twisted.python.failure import Failure
 
+from .codec import JSON, getCodec
+from .exceptions import CodecError
 from .messages import MODE_NONE
 
+# bytes kept free when splitting messages (see sendSplitMessage()),
+# since lists grow slightly more than the sum of their values once encoded
+SPLIT_MESSAGE_RESERVE = 64
+
 class JSONReceiver(LineReceiver):
+  # if enabled, all lines sent during one reactor iteration
+  # will be collected and written to the transport at once
+  coalesce_writes = False
   log = Logger()
+  # codes of the messages which might be received split into several parts
+  split_codes = ()
 
   def __init__(self, factory):
     self.callbacks = {}
+    self.codec = JSON
     self.factory = factory
+    self.flush_call = None
+    self.flushed_messages = 0
+    self.flushes = 0
+    self.frame_buffer = ''
     self.identification = '' # should be shadowed for proper usage
     self.mode = MODE_NONE
+    self.outgoing = []
+    # the producer currently streaming raw data to the transport, if any
+    self.producer = None
     self.raw_args = []
     self.raw_callback = None
-    self.raw_data = ''
+    self.raw_consumer = None
     self.raw_remaining = 0
+    # the parts of split messages received so far, by message code
+    self.split_messages = {}
 
   def lineReceived(self, line):
-    data = json.loads(line)
-    code = int(data["code"])
-    del(data["code"])
+    code, data = self.codec.decode(line)
     self.messageReceived(code, data)
 
+  # handles data received while using a framed codec
+  def framesReceived(self, data):
+    self.frame_buffer += data
+    buffer = bytearray(self.frame_buffer)
+    offset = 0
+
+    while self.raw_callback is None and not self.transport.disconnecting:
+      try:
+        frame = self.codec.readFrame(buffer, offset, self.MAX_LENGTH)
+      except CodecError as e:
+        self.log.warn('{log_source.identification!r} sent an invalid message: {error}', error = str(e))
+        self.frame_buffer = ''
+        self.loseConnection()
+        return
+      if frame is None:
+        break
+      code, message, offset = frame
+      self.messageReceived(code, message)
+
+    rest = self.frame_buffer[offset:]
+
+    if self.raw_callback is not None:
+      # the last message requested raw data, which follows right behind it
+      self.frame_buffer = ''
+      if len(rest):
+        self.dataReceived(rest)
+    else:
+      self.frame_buffer = rest
+
+  # switches to the codec with the given name
+  # all following messages will be sent and expected to be received
+  # using this codec
+  def setCodec(self, name):
+    codec = getCodec(name)
+    if codec is None:
+      raise CodecError('unknown codec %s'%(name))
+    self.codec = codec
+    if codec.framed:
+      self.setRawMode()
+    else:
+      self.setLineMode()
+
   def messageReceived(self, code, data):
-    if not code in self.callbacks[self.mode]:
+    if code in self.split_codes:
+      data = self.joinSplitMessage(code, data)
+      if data is None:
+        return
+    if not code in self.callbacks.get(self.mode, {}):
       self.log.warn('{log_source.identification!r} sent message {code}:{message}, but message not known or not parseable in current mode {log_source.mode!r}', code=code, message=data)
     else:
       self.callbacks[self.mode][code](**data)
 
+  def sendLine(self, line):
+    self.sendData(line + self.delimiter)
+
+  # sends already encoded messages
+  # while a file is being sent, messages will be held back until it finished
+  def sendData(self, data):
+    if not self.coalesce_writes and self.producer is None:
+      return self.transport.write(data)
+
+    self.outgoing.append(data)
+    if self.flush_call is None:
+      self.flush_call = reactor.callLater(0, self.flush)
+
+  # writes all collected lines to the transport
+  def flush(self):
+    if self.flush_call is not None:
+      if self.flush_call.active():
+        self.flush_call.cancel()
+      self.flush_call = None
+
+    if len(self.outgoing) == 0 or self.producer is not None:
+      return
+
+    self.transport.write(''.join(self.outgoing))
+    self.flushes += 1
+    self.flushed_messages += len(self.outgoing)
+    self.outgoing = []
+
+  @property
+  def messages_per_flush(self):
+    if self.flushes == 0:
+      return 0.0
+    return float(self.flushed_messages) / self.flushes
+
+  # closes the connection after writing all pending lines
+  def loseConnection(self):
+    self.flush()
+    self.transport.loseConnection()
+
+  def connectionLost(self, reason):
+    if self.flush_call is not None and self.flush_call.active():
+      self.flush_call.cancel()
+    self.flush_call = None
+    self.frame_buffer = ''
+    self.outgoing = []
+    self.split_messages = {}
+
   def sendMessage(self, code, **data):
-    data["code"] = int(code)
-    self.sendLine(json.dumps(data))
+    self.sendData(self.codec.encode(code, data))
+
+  # sends a message containing lists which might exceed MAX_LENGTH once
+  # encoded, fields names the fields containing those lists
+  # the lists will be split into as many messages as needed, all but the
+  # last one only containing parts of the lists and more = True
+  # the last one contains the remaining parts and all other fields
+  # the receiver needs to name the code within split_codes
+  def sendSplitMessage(self, code, fields, **data):
+    limit = self.MAX_LENGTH - SPLIT_MESSAGE_RESERVE
+    empty = dict((f, []) for f in fields)
+
+    message = data.copy()
+    message.update(empty)
+    message['more'] = True
+    base = len(self.codec.encode(code, message))
+
+    parts = []
+    part = dict((f, []) for f in fields)
+    size = base
+
+    for field in fields:
+      overhead = len(self.codec.encode(code, {field: []}))
+      for value in data[field]:
+        # a separator might be needed in front of every value
+        length = len(self.codec.encode(code, {field: [value]})) - overhead + 2
+        if size + length > limit and size > base:
+          parts.append(part)
+          part = dict((f, []) for f in fields)
+          size = base
+        part[field].append(value)
+        size += length
+
+    for p in parts:
+      self.sendMessage(code, more = True, **p)
+
+    data.update(part)
+    self.sendMessage(code, **data)
+
+  # collects the parts of a message sent by sendSplitMessage()
+  # returns the whole message once the last part was received, None before
+  def joinSplitMessage(self, code, data):
+    parts = self.split_messages.get(code)
+
+    if data.pop('more', False):
+      if parts is None:
+        parts = self.split_messages[code] = {}
+      for field, values in data.iteritems():
+        parts.setdefault(field, []).extend(values)
+      return None
+
+    if parts is not None:
+      del self.split_messages[code]
+      for field, values in parts.iteritems():
+        data[field] = values + list(data.get(field, []))
+
+    return data
+
+  # sends the same message to all receivers (protocols),
+  # but encodes it only once per codec
+  # overlay can be a callable which returns a dict of fields which differ
+  # for the given receiver, those fields need to be hashable
+  # receivers with equal overlays and codecs will share the same encoded message
+  @classmethod
+  def broadcastMessage(cls, receivers, code, overlay = None, **data):
+    encoded = {}
+    for receiver in receivers:
+      fields = overlay(receiver) if overlay is not None else {}
+      key = (receiver.codec, tuple(sorted(fields.items())), )
+      frame = encoded.get(key)
+      if frame is None:
+        message = data.copy()
+        message.update(fields)
+        frame = encoded[key] = receiver.codec.encode(code, message)
+      receiver.sendData(frame)
 
   def addCallback(self, mode, code, callback):
     if not mode in self.callbacks:
@@ -44,21 +230,54 @@ class JSONReceiver(LineReceiver):
   def getMode(self):
     return self.mode
 
-  def sendRawData(self, data):
-    while len(data):
-      self.transport.write(data[:self.MAX_LENGTH])
-      data = data[self.MAX_LENGTH:]
+  # streams the contents of the given file object to the transport
+  # the file will be read chunk by chunk, whenever the transport
+  # is ready to take more data, and closed afterwards
+  def sendFile(self, file):
+    self.flush()
+    self.producer = FileSender()
+    d = self.producer.beginFileTransfer(file, self.transport)
+    d.addBoth(self.fileSent, file)
+    return d
+
+  def fileSent(self, result, file):
+    file.close()
+    self.producer = None
+    if isinstance(result, Failure):
+      self.log.info('{log_source.identification!r} aborted file transfer: {error}', error = result.getErrorMessage())
+      return
+    if not self.transport.disconnecting:
+      self.flush()
 
-  def receiveRawData(self, length, callback, *args):
+  # receives length bytes of raw data
+  # every chunk will be handed to consumer.write() as soon as it arrives,
+  # callback will be called with args once all data was received
+  def receiveRawData(self, length, consumer, callback, *args):
     self.raw_args = args
     self.raw_callback = callback
-    self.raw_data = ''
+    self.raw_consumer = consumer
     self.raw_remaining = length
     self.setRawMode()
+    if length == 0:
+      self.rawDataReceived('')
 
   def rawDataReceived(self, data):
+    if self.raw_callback is None:
+      self.framesReceived(data)
+      return
+
+    overflow = data[self.raw_remaining:]
+    data = data[:self.raw_remaining]
     self.raw_remaining -= len(data)
-    self.raw_data += data
+    if len(data):
+      self.raw_consumer.write(data)
     if self.raw_remaining == 0:
-      self.setLineMode()
-      self.raw_callback(*self.raw_args)
+      callback = self.raw_callback
+      self.raw_callback = None
+      self.raw_consumer = None
+      if not self.codec.framed:
+        self.setLineMode()
+      callback(*self.raw_args)
+      # anything behind the raw data are messages again
+      if len(overflow):
+        self.dataReceived(overflow)